@@ -7,17 +7,34 @@ This is self-contained to simplify bootstrapping.
 """
 
 import argparse
+import asyncio
+import hashlib
+import heapq
 import io
 import json
 import os
+import pickle
+import re
 import shlex
+import sqlite3
+import stat
+import statistics
+import string
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import tomllib
+import urllib.parse
 
 from abc import ABC, abstractmethod
-from collections import ChainMap
+from collections import ChainMap, Counter
 from collections.abc import (
+    Callable,
+    Generator,
+    Hashable,
     Iterable,
     Mapping,
     MutableMapping,
@@ -26,30 +43,233 @@ from collections.abc import (
     Sequence,
     Set,
 )
-from dataclasses import dataclass
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Any, Self, TypeVar
+from typing import Any, BinaryIO, Protocol, Self, TextIO, TypeVar, overload
 
 T = TypeVar('T')
 
 SELF = 'gepare'
 
-def error(s: str) -> None:
-    print(f'{SELF}: {s}', file=sys.stderr)
+# Like `concurrent.futures`, assume origin operations are I/O bound.
+DEFAULT_JOBS = min(32, (os.cpu_count() or 1) + 4)
+# Local operations, like rebasing, are bound by CPU and disk.
+DEFAULT_LOCAL_JOBS = os.cpu_count() or 1
 
-class Expander:
-    """Get from a mapping with lazy recursive format string expansion."""
+# Seconds for which probed remote refs are reused.
+DEFAULT_REF_CACHE_TTL = 600
+
+def error(s: str, file: TextIO | None = None) -> None:
+    print(f'{SELF}: {s}', file=file or sys.stderr)
+
+class Scope(Protocol):
+    """Values a `Template` can refer to, by name."""
+
+    def __getitem__(self, key: str) -> Any:
+        ...
+
+# A field's name, or an attribute in its path, runs to the next `.` or `[`.
+FIELD_NAME_PART = re.compile(r'[^.[]*')
+
+FieldPath = tuple[tuple[bool, int | str], ...]
+
+def _split_field_name(name: str) -> tuple[str, FieldPath]:
+    """Split a field name like `a.b[0]`, as `str.format` does."""
+    match = FIELD_NAME_PART.match(name)
+    assert match
+    first, i = match[0], match.end()
+    path: list[tuple[bool, int | str]] = []
+    while i < len(name):
+        if is_attribute := name[i] == '.':
+            match = FIELD_NAME_PART.match(name, i + 1)
+            assert match
+            key, i = match[0], match.end()
+        else:
+            end = name.find(']', i + 1)
+            if end < 0:
+                raise ValueError("Missing ']' in format string")
+            key, i = name[i + 1 : end], end + 1
+        if not key:
+            raise ValueError('Empty attribute in format string')
+        if i < len(name) and name[i] not in '.[':
+            raise ValueError(
+                "Only '.' or '[' may follow ']' in format field specifier")
+        if is_attribute or not key.isdecimal():
+            path.append((is_attribute, key))
+        else:
+            path.append((False, int(key)))
+    return first, tuple(path)
+
+@dataclass(frozen=True)
+class Field:
+    """A replacement field of a `Template`."""
+    name: str
+    # (is_attribute, key) pairs applied to the value, as in `{a.b[c]}`.
+    path: FieldPath = ()
+    conversion: str | None = None
+    spec: 'Template | None' = None
+
+    def render(self, scope: Scope) -> str:
+        value = scope[self.name]
+        for is_attribute, key in self.path:
+            value = getattr(value, str(key)) if is_attribute else value[key]
+        if self.conversion == 's':
+            value = str(value)
+        elif self.conversion == 'r':
+            value = repr(value)
+        elif self.conversion == 'a':
+            value = ascii(value)
+        return format(value, self.spec.render(scope) if self.spec else '')
+
+class Template:
+    """A format string, parsed once into literal text and fields."""
+
+    # Compiled templates, by source string.
+    _compiled: dict[str, 'Template'] = {}
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.parts: list[str | Field] = []
+        for literal, name, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                self.parts.append(literal)
+            if name is None:
+                continue
+            first, path = _split_field_name(name)
+            if not first or first.isdecimal():
+                raise ValueError('Format string contains positional fields')
+            if conversion not in (None, 's', 'r', 'a'):
+                raise ValueError(f'Unknown conversion specifier {conversion}')
+            self.parts.append(
+                Field(first, path, conversion,
+                      Template.compile(spec) if spec else None))
+        # The result, if there are no fields.
+        self.text: str | None = None
+        # Names the template refers to, in order of first appearance.
+        names: dict[str, None] = {}
+        for part in self.parts:
+            if isinstance(part, Field):
+                names[part.name] = None
+                if part.spec is not None:
+                    names.update(dict.fromkeys(part.spec.names))
+        self.names: tuple[str, ...] = tuple(names)
+        literals = [part for part in self.parts if isinstance(part, str)]
+        if len(literals) == len(self.parts):
+            self.text = ''.join(literals)
+
+    @classmethod
+    def compile(cls, source: str) -> 'Template':
+        """Return the compiled template for a format string."""
+        try:
+            return cls._compiled[source]
+        except KeyError:
+            template = cls._compiled[source] = cls(source)
+            return template
+
+    def render(self, scope: Scope) -> str:
+        if self.text is not None:
+            return self.text
+        return ''.join(
+            part if isinstance(part, str) else part.render(scope)
+            for part in self.parts)
+
+    def render_each(self, scopes: Sequence['Expander'],
+                    shared: 'Expander') -> list[str]:
+        """
+        Render in each of several scopes that extend a `shared` one.
+
+        Each field is rendered once in `shared`, and that result is used for
+        every scope in which the keys it depends on are unchanged; only the
+        remaining fields are rendered per scope.
+        """
+        if self.text is not None:
+            return [self.text] * len(scopes)
+        results: list[list[str]] = [[] for _ in scopes]
+        for part in self.parts:
+            if isinstance(part, str):
+                for result in results:
+                    result.append(part)
+                continue
+            try:
+                value, deps = shared.tracked(part)
+            except (LookupError, AttributeError, TypeError, ValueError):
+                # Rendered, or failed, separately in each scope below.
+                value, deps = '', None
+            for result, scope in zip(results, scopes):
+                if deps is not None and scope.unchanged(deps):
+                    result.append(value)
+                else:
+                    result.append(part.render(scope))
+        return [''.join(result) for result in results]
 
-    def __init__(self, mapping: Mapping) -> None:
+class Expander:
+    """
+    Get from a mapping with lazy recursive format string expansion.
+
+    Values are expanded on demand, so a reference cycle among templates is
+    found when it is first followed; `order()` finds one beforehand.
+
+    Expanded values are cached along with the raw values they were expanded
+    from, and a cached value is used only while looking those up again finds
+    the same objects, so changes within the mapping are noticed. (The
+    nesting of a `ChainMap` mapping, though, is taken as fixed.)
+    An Expander whose mapping extends that of a `parent` (as a package
+    `ChainMap` extends the global one) shares the parent's cache for values
+    that do not depend on anything it overrides.
+    """
+
+    # Raw values that can be checked for change by identity.
+    CACHEABLE = (str, int, float, bool)
+
+    # Per thread, the keys (or None, for `tracked()`) and dependency lists
+    # of the expansions in progress.
+    _tracking = threading.local()
+
+    def __init__(self,
+                 mapping: Mapping,
+                 parent: 'Expander | None' = None) -> None:
         self.scope = mapping
+        self.parent = parent
+        self._maps = chained_maps(mapping)
+        # Expanded value, and the (key, raw value) pairs it came from.
+        self.cache: dict[str, tuple[str, list[tuple[str, Any]]]] = {}
 
     def __getitem__(self, key: str) -> str:
-        value = self.scope[key]
-        return self.expand(value) if isinstance(value, str) else value
+        value = self._lookup(key)
+        stack = self._stack()
+        if not isinstance(value, str) or '{' not in value and '}' not in value:
+            if stack:
+                stack[-1][1].append((key, value))
+            return value
+        entry = self._cached(key)
+        if entry is None:
+            keys = [k for k, _ in stack if k is not None]
+            if key in keys:
+                raise ValueError(
+                    cycle_message([*keys[keys.index(key) :], key]))
+            stack.append((key, [(key, value)]))
+            try:
+                result = self.expand(value)
+            finally:
+                _, deps = stack.pop()
+            entry = (result, deps)
+            if all(isinstance(v, self.CACHEABLE) for _, v in deps):
+                self.cache[key] = entry
+                if self.parent is not None and self.parent.unchanged(deps):
+                    self.parent.cache[key] = entry
+        if stack:
+            stack[-1][1].extend(entry[1])
+        return entry[0]
 
     def __contains__(self, key: str) -> bool:
-        return key in self.scope
+        return any(key in m for m in self._maps)
 
     def get(self, key: str, default: Any | None = None) -> str | Any | None:
         try:
@@ -58,7 +278,148 @@ class Expander:
             return default
 
     def expand(self, s: str) -> str:
-        return s.format_map(self)
+        return Template.compile(s).render(self)
+
+    def graph(self, keys: Iterable[str]) -> dict[str, tuple[str, ...]]:
+        """
+        Return the keys that templates refer to, starting from `keys`.
+
+        The result maps each key reached (that is in scope) to the names
+        its value refers to, so that it also answers which of `keys`
+        depend on a given name.
+        """
+        graph: dict[str, tuple[str, ...]] = {}
+        pending = list(keys)
+        while pending:
+            key = pending.pop(0)
+            if key in graph or key not in self:
+                continue
+            value = self._lookup(key)
+            if isinstance(value, str) and ('{' in value or '}' in value):
+                graph[key] = Template.compile(value).names
+                pending.extend(graph[key])
+            else:
+                graph[key] = ()
+        return graph
+
+    def order(self, keys: Iterable[str]) -> list[str]:
+        """
+        Return `keys` and the keys they refer to, each after its references.
+
+        Raises ValueError, naming the keys, if templates refer in a cycle.
+        """
+        graph = self.graph(keys)
+        order, cycle = depth_first(graph, graph.__getitem__, lambda k: k)
+        if cycle is not None:
+            raise ValueError(cycle_message(cycle))
+        return order
+
+    def evaluate(self, keys: Iterable[str]) -> dict[str, Any]:
+        """
+        Expand keys, after checking for cycles, in dependency order.
+
+        Keys that are missing, or refer to missing keys, are left out.
+        """
+        keys = list(keys)
+        values: dict[str, Any] = {}
+        for key in self.order(keys):
+            try:
+                values[key] = self[key]
+            except KeyError:
+                pass
+        return {key: values[key] for key in keys if key in values}
+
+    def unchanged(self, deps: Iterable[tuple[str, Any]]) -> bool:
+        """Check that keys still have the given raw values in this scope."""
+        for k, v in deps:
+            for m in self._maps:
+                if k in m:
+                    if m[k] is not v:
+                        return False
+                    break
+            else:
+                return False
+        return True
+
+    def _lookup(self, key: str) -> Any:
+        for m in self._maps:
+            if key in m:
+                return m[key]
+        raise KeyError(key)
+
+    def _cached(self, key: str) -> tuple[str, list[tuple[str, Any]]] | None:
+        expander: Expander | None = self
+        while expander is not None:
+            entry = expander.cache.get(key)
+            if entry is not None and self.unchanged(entry[1]):
+                return entry
+            expander = expander.parent
+        return None
+
+    def tracked(self, field: Field) -> tuple[str, list[tuple[str, Any]]]:
+        """Render a field, with the (key, raw value) pairs it depends on."""
+        stack = self._stack()
+        stack.append((None, []))
+        try:
+            result = field.render(self)
+        finally:
+            _, deps = stack.pop()
+        if stack:
+            stack[-1][1].extend(deps)
+        return result, deps
+
+    def _stack(self) -> list[tuple[str | None, list[tuple[str, Any]]]]:
+        try:
+            return self._tracking.stack
+        except AttributeError:
+            self._tracking.stack = []
+            return self._tracking.stack
+
+def chained_maps(mapping: Mapping) -> list[Mapping]:
+    """Return the mappings that a (possibly nested) `ChainMap` searches."""
+    if isinstance(mapping, ChainMap):
+        return [m for child in mapping.maps for m in chained_maps(child)]
+    return [mapping]
+
+def cycle_message(keys: Iterable[str]) -> str:
+    return 'circular template references: ' + ' → '.join(keys)
+
+def depth_first(nodes: Iterable[T], edges: Callable[[T], Iterable[T]],
+                key: Callable[[T], Hashable]) -> tuple[list[T], list[T] | None]:
+    """
+    Order `nodes` so that each comes after the nodes its `edges` lead to.
+
+    Nodes are identified by `key`, and edges to nodes not in `nodes` are
+    ignored. If the edges form a cycle, the second result is the nodes
+    along it, with the first repeated at the end, and the order is
+    incomplete.
+    """
+    nodes = list(nodes)
+    keys = {key(node) for node in nodes}
+    order: list[T] = []
+    done: set[Hashable] = set()
+    for root in nodes:
+        if key(root) in done:
+            continue
+        # Keep the current path and its unvisited edges.
+        path = [root]
+        pending = [iter(edges(root))]
+        while path:
+            for node in pending[-1]:
+                k = key(node)
+                if k not in keys or k in done:
+                    continue
+                for i, p in enumerate(path):
+                    if key(p) == k:
+                        return order, [*path[i :], node]
+                path.append(node)
+                pending.append(iter(edges(node)))
+                break
+            else:
+                done.add(key(path[-1]))
+                order.append(path.pop())
+                pending.pop()
+    return order, None
 
 def ndget(d: Mapping[T, Any],
           keys: Iterable[T],
@@ -95,6 +456,12 @@ def ndupdate(d: MutableMapping, s: Mapping) -> MutableMapping:
         raise TypeError(k, d[k], v)
     return d
 
+def option_bool(value: Any) -> bool:
+    """Interpret a configuration value, possibly from `--define`, as a flag."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
 def shell_escape(s: str, *, interpolatable: bool = True) -> str:
     if not interpolatable:
         return shlex.quote(s)
@@ -116,6 +483,64 @@ def toml_escape(s: str) -> str:
             r.append(c)
     return ''.join(r)
 
+# Like Git, treat `[user@]host:path` as scp-style only if there is no slash
+# before the colon.
+SCP_SOURCE = re.compile(r'(?:[^@/]*@)?(\[[^]/]*\]|[^:/]+):')
+
+def source_host(src: str) -> str:
+    """Get the network host of an origin source, or '' if it is local."""
+    if '://' in src:
+        url = urllib.parse.urlsplit(src)
+        return '' if url.scheme == 'file' else (url.hostname or '')
+    m = SCP_SOURCE.match(src)
+    return m.group(1).strip('[]').lower() if m else ''
+
+def normalize_source(src: str) -> str:
+    """Normalize an origin source so that equivalent spellings compare equal."""
+    src = src.strip().rstrip('/')
+    if '://' in src:
+        url = urllib.parse.urlsplit(src)
+        src = urllib.parse.urlunsplit((url.scheme.lower(), url.netloc.lower(),
+                                       url.path.rstrip('/'), url.query, ''))
+    return src
+
+def source_location(src: str) -> tuple[str, str]:
+    """
+    Get the host and path of a network origin source.
+
+    The scheme, user and port are left out, as is any `.git` suffix, since
+    a server usually accepts the same repository under each of these.
+    """
+    if '://' in src:
+        url = urllib.parse.urlsplit(src.strip())
+        host, path = url.hostname or '', url.path
+    elif m := SCP_SOURCE.match(src.strip()):
+        host, path = m.group(1).strip('[]'), src.strip()[m.end() :]
+    else:
+        host, path = '', src
+    return host.lower(), path.strip('/').removesuffix('.git').rstrip('/')
+
+def same_source(a: str, b: str) -> bool:
+    """Check whether two origin sources refer to the same thing."""
+    a, b = (s.removeprefix('file://') for s in (a, b))
+    if source_host(a) and source_host(b):
+        return source_location(a) == source_location(b)
+    if source_host(a) or source_host(b) or '://' in a or '://' in b:
+        return normalize_source(a) == normalize_source(b)
+    # Local paths may be spelled relative to the current directory.
+    return os.path.realpath(a) == os.path.realpath(b)
+
+def parse_duration(value: str | float) -> float:
+    """Convert a duration like `90`, `10m`, or `1h30m` to seconds."""
+    if isinstance(value, int | float) and not isinstance(value, bool):
+        return float(value)
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    number = r'(\d+(?:\.\d*)?)([smhdw]?)'
+    s = str(value).replace(' ', '').lower()
+    if not re.fullmatch(f'(?:{number})+', s):
+        raise ValueError(f'invalid duration ‘{value}’')
+    return sum(float(n) * units[u] for n, u in re.findall(number, s))
+
 def xdg_dir(name: str, default_dir: str) -> Path:
     evar = f'XDG_{name}_HOME'
     if evar in os.environ:
@@ -134,97 +559,863 @@ class OriginStatus(Enum):
     UNCHANGED = 0
     ERROR = 1
     UNKNOWN = 2
-    UPGRADABLE = 3  # Not implemented yet.
+    UPGRADABLE = 3
     DIRTY = 4
 
+class RemoteRefs:
+    """
+    Refs of remote origins, shared between origins in a run.
+
+    If a `path` is given, successful probes are saved there, and saved
+    refs younger than `ttl` seconds are used instead of probing again,
+    unless `refresh` is set.
+    """
+
+    def __init__(self,
+                 path: Path | None = None,
+                 ttl: float = 0,
+                 *,
+                 refresh: bool = False) -> None:
+        # A value of `None` records that probing the remote failed.
+        self.refs: dict[str, dict[str, str] | None] = {}
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.saved: dict[str, dict[str, Any]] = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if path is not None:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.saved = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            if key in self.refs:
+                return True
+            if self.refresh or key not in self.saved:
+                return False
+            entry = self.saved[key]
+            if time.time() - entry['time'] >= self.ttl:
+                return False
+            self.refs[key] = entry['refs']
+            self.hits += 1
+            return True
+
+    def get(self, key: str) -> dict[str, str] | None:
+        return self.refs.get(key)
+
+    def put(self, key: str, refs: dict[str, str] | None) -> None:
+        with self.lock:
+            self.refs[key] = refs
+            self.misses += 1
+            if refs is not None and self.path is not None:
+                self.saved[key] = {'time': time.time(), 'refs': refs}
+                self.changed = True
+
+    def save(self) -> None:
+        """Write unexpired refs to `path`, if anything was probed."""
+        if self.path is None or not self.changed:
+            return
+        now = time.time()
+        saved = {
+            k: v
+            for k, v in self.saved.items() if now - v['time'] < self.ttl
+        }
+        text = json.dumps(saved).encode()
+        replace_file(self.path, lambda f: f.write(text))
+        self.changed = False
+
+class StatCache:
+    """
+    Stat fingerprints of local copies last found clean, shared in a run.
+
+    A local copy whose fingerprint has not changed is taken to be still
+    clean, without scanning it, unless `exact` is set. If a `path` is given,
+    fingerprints are loaded from and saved there.
+    """
+
+    def __init__(self,
+                 path: Path | None = None,
+                 *,
+                 exact: bool = False) -> None:
+        self.path = path
+        self.exact = exact
+        self.fingerprints: dict[str, Any] = {}
+        self.hits = 0
+        self.changed = False
+        self.lock = threading.Lock()
+        if path is not None:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.fingerprints = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def clean(self, key: str, fingerprint: Any) -> bool:
+        """Check whether `key` was clean with the same fingerprint."""
+        with self.lock:
+            if self.exact or self.fingerprints.get(key) != fingerprint:
+                return False
+            self.hits += 1
+            return True
+
+    def put(self, key: str, fingerprint: Any) -> None:
+        """Record that `key` is clean, or with `None`, that it may not be."""
+        with self.lock:
+            if fingerprint is None:
+                self.changed |= self.fingerprints.pop(key, None) is not None
+            elif self.fingerprints.get(key) != fingerprint:
+                self.fingerprints[key] = fingerprint
+                self.changed = True
+
+    def save(self) -> None:
+        """Write fingerprints to `path`, if any changed."""
+        if self.path is None or not self.changed:
+            return
+        text = json.dumps(self.fingerprints).encode()
+        replace_file(self.path, lambda f: f.write(text))
+        self.changed = False
+
+class FileTypes:
+    """
+    Types of local paths, read once and shared between origins in a run.
+
+    `probe()` reads many paths at once: paths that share a parent directory
+    are found by listing it, which on most file systems needs no `stat()`
+    of each entry. Paths not probed are checked directly each time.
+    """
+
+    def __init__(self) -> None:
+        # Maps paths to 'dir', 'symlink', 'file', or `None` if missing.
+        self.types: dict[Path, str | None] = {}
+        self.lock = threading.Lock()
+
+    def probe(self, paths: Iterable[Path]) -> None:
+        """Read the types of `paths`."""
+        parents: dict[Path, set[str]] = {}
+        for path in paths:
+            parents.setdefault(path.parent, set()).add(path.name)
+        types: dict[Path, str | None] = {}
+        for parent, names in parents.items():
+            if len(names) == 1:
+                path = parent / names.pop()
+                try:
+                    types[path] = self._type(os.lstat(path).st_mode)
+                except FileNotFoundError:
+                    types[path] = None
+                except OSError:
+                    pass
+                continue
+            try:
+                with os.scandir(parent) as entries:
+                    for entry in entries:
+                        if entry.name in names:
+                            types[parent / entry.name] = self._entry_type(
+                                entry)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            except OSError:
+                continue
+            for name in names:
+                types.setdefault(parent / name, None)
+        with self.lock:
+            self.types.update(types)
+
+    def forget(self, path: Path) -> None:
+        """Drop what is known of `path` and anything in it, after changes."""
+        with self.lock:
+            for known in [p for p in self.types if p.is_relative_to(path)]:
+                del self.types[known]
+
+    def exists(self, path: Path) -> bool:
+        if self._follow(path):
+            return path.exists()
+        return self.types[path] is not None
+
+    def is_dir(self, path: Path) -> bool:
+        if self._follow(path):
+            return path.is_dir()
+        return self.types[path] == 'dir'
+
+    def is_symlink(self, path: Path) -> bool:
+        if path not in self.types:
+            return path.is_symlink()
+        return self.types[path] == 'symlink'
+
+    def _follow(self, path: Path) -> bool:
+        """Whether `path` must be checked directly, following links."""
+        return self.types.get(path, 'symlink') == 'symlink'
+
+    @staticmethod
+    def _type(mode: int) -> str:
+        if stat.S_ISLNK(mode):
+            return 'symlink'
+        return 'dir' if stat.S_ISDIR(mode) else 'file'
+
+    @staticmethod
+    def _entry_type(entry: os.DirEntry) -> str:
+        if entry.is_symlink():
+            return 'symlink'
+        return 'dir' if entry.is_dir(follow_symlinks=False) else 'file'
+
+def replace_file(path: Path, dump: Callable[[BinaryIO], object]) -> None:
+    """Replace a file atomically with what `dump` writes, reporting errors."""
+    temp = path.with_name(f'{path.name}.{os.getpid()}')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(temp, 'wb') as f:
+            dump(f)
+        temp.replace(path)
+    except OSError as e:
+        error(f'{path}: {e}')
+
+class StateStore:
+    """
+    Persistent record of package operations, in an SQLite database.
+
+    Each operation on a package (such as `fetch`, `integrate`, or `status`)
+    is recorded, under the package's key, with its start time, duration,
+    exit status (0 for success), the local copy's commit before and after,
+    and the bytes of output. Each record is committed as it is made, so
+    that concurrent runs see it, and only the latest `KEEP` of each
+    operation on a package are kept.
+    """
+
+    # Recorded operations kept for each package and operation.
+    KEEP = 20
+    # Seconds to wait for another process's write to finish.
+    TIMEOUT = 30.0
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS operation (
+            package TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            status INTEGER NOT NULL,
+            head_before TEXT,
+            head_after TEXT,
+            output_bytes INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS operation_package
+            ON operation (package, operation, started);
+    '''
+
+    def __init__(self, path: Path | str = ':memory:') -> None:
+        if isinstance(path, Path):
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # Operations are recorded from worker threads, under `lock`.
+        self.db = sqlite3.connect(
+            path, timeout=self.TIMEOUT, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # Let other runs read while this one writes.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            with self.db:
+                self.db.executescript(self.SCHEMA)
+
+    def record(self, package: str, operation: str, started: float,
+               duration: float, status: int, head_before: str | None,
+               head_after: str | None, output_bytes: int) -> None:
+        """Record an operation; failing to is reported, not raised."""
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute(
+                        'INSERT INTO operation VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (package, operation, started, duration, status,
+                         head_before, head_after, output_bytes))
+                    self.db.execute(
+                        'DELETE FROM operation'
+                        ' WHERE package = ? AND operation = ? AND started < ('
+                        'SELECT started FROM operation'
+                        ' WHERE package = ? AND operation = ?'
+                        ' ORDER BY started DESC LIMIT 1 OFFSET ?)',
+                        (package, operation, package, operation,
+                         self.KEEP - 1))
+            except sqlite3.Error as e:
+                error(f'{self.path}: could not record {operation} of'
+                      f' {package}: {e}')
+
+    def history(self, package: str,
+                operation: str) -> list[dict[str, Any]]:
+        """Get recorded runs of an operation on a package, newest first."""
+        with self.lock:
+            cursor = self.db.execute(
+                'SELECT * FROM operation WHERE package = ? AND operation = ?'
+                ' ORDER BY started DESC', (package, operation))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor]
+
+    def duration(self, package: str, operation: str) -> float | None:
+        """Get the typical duration of recent successful operations."""
+        with self.lock:
+            durations = [
+                row[0] for row in self.db.execute(
+                    'SELECT duration FROM operation'
+                    ' WHERE package = ? AND operation = ? AND status = 0'
+                    ' ORDER BY started DESC LIMIT 5', (package, operation))
+            ]
+        return statistics.median(durations) if durations else None
+
+    def last_refresh(self, package: str) -> float | None:
+        """
+        Get the start time of a package's last successful refresh.
+
+        A refresh is a clone or fetch, and any integration of what it
+        fetched; if the latest integration failed, the package still needs
+        refreshing, so there is no time.
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                'SELECT operation, started, status FROM operation'
+                ' WHERE package = ? AND operation IN'
+                " ('clone', 'fetch', 'integrate') ORDER BY started DESC",
+                (package, ))
+            for operation, started, status in cursor:
+                if status == 0:
+                    return started
+                if operation == 'integrate':
+                    return None
+        return None
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+@dataclass
+class Command:
+    """A subprocess required by an origin operation."""
+
+    args: Sequence[str]
+    kwargs: dict[str, Any] = field(default_factory=dict)
+
+# Origin operations are written as generators that yield the commands they
+# need run, and receive the results, so that the same implementation can be
+# driven either by `subprocess.run` or by asyncio subprocesses.
+Steps = Generator[Command, subprocess.CompletedProcess, T]
+
 class Origin(ABC):
     """Base class for package origin methods."""
 
     subclass: dict[str, type[Self]] = {}
+    vcs: str = ''
 
-    def __init__(self, name: str, remote: str | Path, local: Path) -> None:
+    def __init__(self,
+                 name: str,
+                 remote: str | Path,
+                 local: Path,
+                 options: Expander | None = None) -> None:
         self.name = name
         self.remote = remote
         self.local = local
+        # Package configuration, for origin-specific settings.
+        self.options = options if options is not None else Expander({})
+        # Output streams; `None` means the current `sys.stdout`/`sys.stderr`.
+        self.stdout: TextIO | None = None
+        self.stderr: TextIO | None = None
+        # Remote refs shared with other origins; see `probe()`.
+        self.refs: RemoteRefs | None = None
+        # Fingerprints of clean local copies; see `status()`.
+        self.stats: StatCache | None = None
+        # Types of local paths, shared with other origins; see `FileTypes`.
+        self.files: FileTypes | None = None
+        # An origin with the same source, already refreshed in this run,
+        # to fetch from instead of the remote; see `deduplicate()`.
+        self.peer: Origin | None = None
 
     def __init_subclass__(cls, name: str) -> None:
         cls.subclass[name] = cls
+        cls.vcs = name
+
+    @property
+    def host(self) -> str:
+        return source_host(str(self.remote))
+
+    @property
+    def source_key(self) -> str:
+        return f'{self.vcs}:{normalize_source(str(self.remote))}'
+
+    @property
+    def probe_key(self) -> str:
+        """Key under which `probe()` results are shared and cached."""
+        return self.source_key
+
+    @property
+    def mirror(self) -> Path | None:
+        """Local mirror of the remote, shared by origins with one source."""
+        return None
+
+    @property
+    def shareable(self) -> bool:
+        """Whether this origin can fetch from a `peer`."""
+        return False
+
+    def probe_paths(self) -> list[Path]:
+        """Local paths whose types origin operations check."""
+        return [self.local]
+
+    def local_exists(self) -> bool:
+        return self._exists(self.local)
+
+    def head(self) -> str | None:
+        """The local copy's current commit, if it can be read cheaply."""
+        return None
+
+    def size(self) -> int | None:
+        """Approximate size of the local repository, if cheaply known."""
+        return None
 
     def refresh(self) -> bool:
-        return self.update() if self.local.exists() else self.clone()
+        return self.update() if self.local_exists() else self.clone()
 
     def update(self) -> bool:
-        return self._update() if self._check() else False
+        return self._drive(self._update()) if self._check() else False
 
     def clone(self) -> bool:
-        return self._clone() if self.check_local_is_available() else False
+        if not self.check_local_is_available():
+            return False
+        try:
+            return self._drive(self._clone())
+        finally:
+            self._forget_local()
 
     def status(self) -> OriginStatus:
-        return self._status() if self._check() else OriginStatus.ERROR
+        if not self._check():
+            return OriginStatus.ERROR
+        return self._drive(self._status())
+
+    def probe(self) -> bool:
+        """Read the remote's refs into `self.refs`, if not already there."""
+        return self._drive(self._remote_refs()) is not None
+
+    def fetch(self) -> OriginStatus:
+        """
+        Fetch from the remote without changing local files.
+
+        Returns `UPGRADABLE` if `integrate()` has changes to apply,
+        `UNCHANGED` if not, or `ERROR`. Together, `fetch()` and
+        `integrate()` do the same as `update()`.
+        """
+        if not self._check():
+            return OriginStatus.ERROR
+        return self._drive(self._fetch())
+
+    def integrate(self) -> bool:
+        """Apply changes obtained by `fetch()` to the local copy."""
+        return self._drive(self._integrate()) if self._check() else False
+
+    def close(self) -> None:
+        """Release any resources, such as helper processes, held."""
+
+    def deepen(self) -> bool:
+        """Fetch the complete history of a shallow local copy."""
+        return self._drive(self._deepen()) if self._check() else False
+
+    def update_mirror(self) -> bool:
+        """Create or update the local mirror of the remote, if any."""
+        return self._drive(self._update_mirror())
+
+    async def arefresh(self) -> bool:
+        if self.local_exists():
+            return await self.aupdate()
+        return await self.aclone()
+
+    async def aupdate(self) -> bool:
+        if not self._check():
+            return False
+        return await self._adrive(self._update())
+
+    async def aclone(self) -> bool:
+        if not self.check_local_is_available():
+            return False
+        try:
+            return await self._adrive(self._clone())
+        finally:
+            self._forget_local()
+
+    async def astatus(self) -> OriginStatus:
+        if not self._check():
+            return OriginStatus.ERROR
+        return await self._adrive(self._status())
+
+    async def aprobe(self) -> bool:
+        return await self._adrive(self._remote_refs()) is not None
+
+    async def afetch(self) -> OriginStatus:
+        if not self._check():
+            return OriginStatus.ERROR
+        return await self._adrive(self._fetch())
+
+    async def aintegrate(self) -> bool:
+        if not self._check():
+            return False
+        return await self._adrive(self._integrate())
+
+    async def adeepen(self) -> bool:
+        if not self._check():
+            return False
+        return await self._adrive(self._deepen())
+
+    async def aupdate_mirror(self) -> bool:
+        return await self._adrive(self._update_mirror())
 
     def bootstrap(self) -> bool:
-        print(f'mkdir -p {shell_escape(str(self.local.parent))}')
+        self.print(f'mkdir -p {shell_escape(str(self.local.parent))}')
         return self._bootstrap()
 
+    def print(self, *args) -> None:
+        print(*args, file=self.stdout)
+
+    def error(self, s: str) -> None:
+        error(f'{self.name}: {s}', file=self.stderr)
+
+    def check_options(self) -> None:
+        """Raise `ValueError` if any of the package's settings is invalid."""
+
     def check_local_is_dir(self) -> bool:
-        if not self.local.exists():
-            error(f'{self.name}: {self.local} does not exist.')
+        if not self._exists(self.local):
+            self.error(f'{self.local} does not exist.')
             return False
-        if not self.local.is_dir():
-            error(f'{self.name}: {self.local} is not a directory.')
+        if not self._is_dir(self.local):
+            self.error(f'{self.local} is not a directory.')
             return False
         return True
 
     def check_local_is_available(self) -> bool:
-        if self.local.exists():
-            error(f'{self.name}: {self.local} already exists.')
+        if self._exists(self.local):
+            self.error(f'{self.local} already exists.')
             return False
         if not self.local.parent.is_dir():
             try:
                 self.local.parent.mkdir(parents=True)
             except OSError as e:
-                error(f'{self.name}: {self.local} could not be created: {e}.')
+                self.error(f'{self.local} could not be created: {e}.')
                 return False
         return True
 
+    def _exists(self, path: Path) -> bool:
+        return self.files.exists(path) if self.files else path.exists()
+
+    def _is_dir(self, path: Path) -> bool:
+        return self.files.is_dir(path) if self.files else path.is_dir()
+
+    def _is_symlink(self, path: Path) -> bool:
+        return self.files.is_symlink(path) if self.files else path.is_symlink()
+
+    def _forget_local(self) -> None:
+        """Discard cached types of local paths, after changing them."""
+        if self.files is not None:
+            self.files.forget(self.local)
+
     @abstractmethod
     def _check(self) -> bool:
         return False
 
     @abstractmethod
-    def _clone(self) -> bool:
+    def _clone(self) -> Steps[bool] | bool:
         pass
 
     @abstractmethod
-    def _update(self) -> bool:
+    def _update(self) -> Steps[bool] | bool:
         pass
 
     @abstractmethod
-    def _status(self) -> OriginStatus:
+    def _status(self) -> Steps[OriginStatus] | OriginStatus:
         return OriginStatus.UNKNOWN
 
     @abstractmethod
     def _bootstrap(self) -> bool:
         pass
 
+    def _probe(self) -> Steps[dict[str, str] | None] | dict[str, str] | None:
+        """Read refs from the remote, returning `None` on failure."""
+        return {}
+
+    def _update_mirror(self) -> Steps[bool] | bool:
+        return True
+
+    def _deepen(self) -> Steps[bool] | bool:
+        return True
+
+    def _fetch(self) -> Steps[OriginStatus]:
+        # By default, do the whole update while fetching.
+        ok = yield from self._steps(self._update())
+        return OriginStatus.UNCHANGED if ok else OriginStatus.ERROR
+
+    def _integrate(self) -> Steps[bool] | bool:
+        return True
+
+    @staticmethod
+    def _steps(steps: Steps[T] | T) -> Steps[T]:
+        """Run an operation from within another."""
+        if isinstance(steps, Generator):
+            return (yield from steps)
+        return steps
+
+    def _remote_refs(self) -> Steps[dict[str, str] | None]:
+        key = self.probe_key
+        if self.refs is not None and key in self.refs:
+            return self.refs.get(key)
+        refs = yield from self._steps(self._probe())
+        if self.refs is not None:
+            self.refs.put(key, refs)
+        return refs
+
     @classmethod
     def vcs_by_name(cls, name: str) -> type['Origin']:
         return cls.subclass[name]
 
-    def _runp(self, command: Sequence[str],
-              **kwargs) -> subprocess.CompletedProcess:
+    @overload
+    def _drive(self, steps: Steps[T]) -> T:
+        ...
+
+    @overload
+    def _drive(self, steps: T) -> T:
+        ...
+
+    def _drive(self, steps: Steps[T] | T) -> T:
+        """Run an operation's commands with `subprocess.run`."""
+        if not isinstance(steps, Generator):
+            return steps
+        try:
+            command = next(steps)
+            while True:
+                command = steps.send(self._execute(command))
+        except StopIteration as e:
+            return e.value
+
+    @overload
+    async def _adrive(self, steps: Steps[T]) -> T:
+        ...
+
+    @overload
+    async def _adrive(self, steps: T) -> T:
+        ...
+
+    async def _adrive(self, steps: Steps[T] | T) -> T:
+        """Run an operation's commands as asyncio subprocesses."""
+        if not isinstance(steps, Generator):
+            return steps
+        try:
+            command = next(steps)
+            while True:
+                command = steps.send(await self._aexecute(command))
+        except StopIteration as e:
+            return e.value
+
+    def _execute(self, command: Command) -> subprocess.CompletedProcess:
         return subprocess.run(
-            command, check=False, text=True, capture_output=True, **kwargs)
+            command.args,
+            check=False,
+            text=True,
+            capture_output=True,
+            **command.kwargs)
+
+    async def _aexecute(self,
+                        command: Command) -> subprocess.CompletedProcess:
+        p = await asyncio.create_subprocess_exec(
+            *command.args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            **command.kwargs)
+        stdout, stderr = await p.communicate()
+        assert p.returncode is not None
+        return subprocess.CompletedProcess(command.args, p.returncode,
+                                           stdout.decode(), stderr.decode())
+
+    def _runp(self, command: Sequence[str],
+              **kwargs) -> Steps[subprocess.CompletedProcess]:
+        return (yield Command(command, kwargs))
+
+    def _run(self, command: Sequence[str], **kwargs) -> Steps[bool]:
+        p = yield from self._runp(command, **kwargs)
+        self._report(p)
+        return p.returncode == 0
 
-    def _run(self, command: Sequence[str], **kwargs) -> bool:
-        p = self._runp(command, **kwargs)
+    def _report(self, p: subprocess.CompletedProcess) -> None:
         if p.stderr or p.stdout:
-            print(f'{self.name}:')
+            self.print(f'{self.name}:')
             if p.stderr:
-                print(p.stderr)
+                self.print(p.stderr)
             if p.stdout:
-                print(p.stdout)
-        return p.returncode == 0
+                self.print(p.stdout)
+
+# Refspecs mapping the remote's branches, as held by a bare mirror or by
+# another clone, to remote-tracking branches.
+MIRROR_REFSPEC = '+refs/heads/*:refs/remotes/origin/*'
+PEER_REFSPEC = '+refs/remotes/origin/*:refs/remotes/origin/*'
+
+class GitReader:
+    """
+    Read a Git repository's refs and configuration directly.
+
+    Cheap queries, like the current branch, are answered without starting
+    `git`. Repositories that need more than this understands, such as
+    worktrees (with a `.git` file), reftable refs, or configuration
+    includes, raise `ValueError`; callers should then run `git` instead.
+    Refs that cannot be read are treated as missing.
+    """
+
+    OID = re.compile(r'[0-9a-f]{40}(?:[0-9a-f]{24})?')
+
+    def __init__(self, local: Path) -> None:
+        self.git = local / '.git'
+        if not os.path.isdir(self.git):
+            raise ValueError(f'{self.git} is not a directory')
+        if os.path.exists(self.git / 'commondir'):
+            raise ValueError(f'{self.git} is a worktree')
+        self._head = self._read('HEAD')
+        if self._head is None:
+            raise ValueError(f'{self.git} has no HEAD')
+        self.config = parse_git_config(self._read('config') or '')
+        if any(k.startswith(('include.', 'includeif.')) for k in self.config):
+            raise ValueError(f'{self.git} config has includes')
+        if self.get('extensions.refstorage', 'files') != 'files':
+            raise ValueError(f'{self.git} does not use files for refs')
+        self._packed: dict[str, str] | None = None
+
+    def get(self, key: str, default: str | None = None) -> str | None:
+        """Get the last value of a configuration variable."""
+        values = self.config.get(key)
+        return values[-1] if values else default
+
+    @property
+    def head_ref(self) -> str | None:
+        """The ref that HEAD points to, or `None` if HEAD is detached."""
+        target = (self._head or '').strip()
+        return target[5 :].strip() if target.startswith('ref: ') else None
+
+    @property
+    def head(self) -> str | None:
+        """The object ID of HEAD, or `None` on an unborn branch."""
+        return self.resolve('HEAD')
+
+    def resolve(self, ref: str) -> str | None:
+        """Get the object ID a ref refers to, following symbolic refs."""
+        for _ in range(5):
+            value = self._head if ref == 'HEAD' else self._read(ref)
+            if value is None:
+                return self._packed_refs().get(ref)
+            value = value.strip()
+            if not value.startswith('ref: '):
+                return value if self.OID.fullmatch(value) else None
+            ref = value[5 :].strip()
+        return None
+
+    def upstream(self) -> tuple[str, str] | None:
+        """The current branch's upstream remote and remote branch ref."""
+        branch = self.head_ref
+        if branch is None or not branch.startswith('refs/heads/'):
+            return None
+        name = branch.removeprefix('refs/heads/')
+        remote = self.get(f'branch.{name}.remote')
+        merge = self.get(f'branch.{name}.merge')
+        if remote is None or merge is None:
+            return None
+        return remote, merge
+
+    def tracking_ref(self) -> str | None:
+        """The local ref that holds the current branch's upstream."""
+        upstream = self.upstream()
+        if upstream is None:
+            return None
+        remote, merge = upstream
+        if remote == '.':
+            return merge
+        for refspec in self.config.get(f'remote.{remote}.fetch', []):
+            src, _, dst = refspec.removeprefix('+').partition(':')
+            if src == merge:
+                return dst
+            if src.endswith('/*') and dst.endswith('/*') and merge.startswith(
+                    src[:-1]):
+                return dst[:-1] + merge[len(src) - 1 :]
+        return None
+
+    def remote_url(self) -> str | None:
+        """The URL of the current branch's upstream remote, or `origin`."""
+        upstream = self.upstream()
+        remote = upstream[0] if upstream else 'origin'
+        return self.get(f'remote.{remote}.url')
+
+    def _packed_refs(self) -> dict[str, str]:
+        if self._packed is None:
+            self._packed = {}
+            for line in (self._read('packed-refs') or '').splitlines():
+                oid, _, ref = line.partition(' ')
+                if self.OID.fullmatch(oid):
+                    self._packed[ref] = oid
+        return self._packed
+
+    def _read(self, name: str) -> str | None:
+        """Read a file in the Git directory, if it exists."""
+        try:
+            with open(self.git / name, encoding='utf-8') as f:
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+def parse_git_config(text: str) -> dict[str, list[str]]:
+    """
+    Parse a Git configuration file.
+
+    Variables are keyed as `section.subsection.name`, with the section and
+    name in lower case, and map to all of their values in order. Anything
+    not understood, such as a continued line, raises `ValueError`.
+    """
+    config: dict[str, list[str]] = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if m := re.fullmatch(
+                r'\[\s*([\w.-]+)\s*(?:"((?:[^"\\]|\\.)*)")?\s*\]\s*'
+                r'(?:[#;].*)?(.*)', line):
+            section = m.group(1).lower()
+            if m.group(2) is not None:
+                section += '.' + re.sub(r'\\(.)', r'\1', m.group(2))
+            line = m.group(3)
+            if not line:
+                continue
+        m = re.fullmatch(r'([a-zA-Z][\w-]*)\s*(?:=\s*(.*))?', line)
+        if section is None or not m:
+            raise ValueError(f'unsupported config line {line!r}')
+        value = 'true' if m.group(2) is None else _git_config_value(m.group(2))
+        config.setdefault(f'{section}.{m.group(1).lower()}', []).append(value)
+    return config
+
+def _git_config_value(raw: str) -> str:
+    escapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+    value = []
+    # Length of the value without unquoted trailing whitespace.
+    end = 0
+    quoted = False
+    chars = iter(raw)
+    for c in chars:
+        if c == '\\':
+            c = next(chars, '')
+            if c not in escapes:
+                raise ValueError(f'unsupported config value {raw!r}')
+            value.append(escapes[c])
+            end = len(value)
+        elif c == '"':
+            quoted = not quoted
+        elif c in '#;' and not quoted:
+            break
+        else:
+            value.append(c)
+            if quoted or not c.isspace():
+                end = len(value)
+    if quoted:
+        raise ValueError(f'unterminated config value {raw!r}')
+    return ''.join(value[: end])
 
 class GitOrigin(Origin, name='git'):
     """A package under Git version control with a remote master."""
@@ -232,109 +1423,1306 @@ class GitOrigin(Origin, name='git'):
     def _check(self) -> bool:
         if not self.check_local_is_dir():
             return False
-        if not self.local.joinpath('.git').is_dir():
-            error(f'{self.name}: {self.local} is not a Git repository.')
+        if not self._is_dir(self.local / '.git'):
+            self.error(f'{self.local} is not a Git repository.')
+            return False
+        reader = self._reader()
+        url = reader.remote_url() if reader else None
+        if url is not None and not source_host(url) and '://' not in url:
+            # Git resolves a relative path from the working tree.
+            url = os.path.join(self.local, url)
+        if url is not None and not same_source(url, str(self.remote)):
+            self.error(f'{self.local} has upstream {url}, not {self.remote}.')
             return False
-        # TODO: check that the upstream matches `self.src`.
         return True
 
+    def probe_paths(self) -> list[Path]:
+        return [self.local, self.local / '.git']
+
+    def head(self) -> str | None:
+        reader = self._reader()
+        return reader.head if reader else None
+
+    def size(self) -> int | None:
+        # Most of the history is in packs, and the index grows with the
+        # working tree.
+        git = self.local / '.git'
+        try:
+            size = os.stat(git / 'index').st_size
+            with os.scandir(git / 'objects' / 'pack') as packs:
+                size += sum(entry.stat().st_size for entry in packs)
+        except OSError:
+            return None
+        return size
+
     def _bootstrap(self) -> bool:
         local = shell_escape(str(self.local))
-        print(f'if test -d {local}')
-        print(f'then (cd {local} && git pull --rebase)')
-        print(f'else git clone {shell_escape(str(self.remote))} {local}')
-        print('fi')
+        update = self._update_commands(shallow=bool(self.depth))
+        clone = ' '.join(
+            ['git', 'clone', *(shlex.quote(a) for a in self._clone_options())])
+        clone = f'{clone} {shell_escape(str(self.remote))} {local}'
+        if self.sparse is not None:
+            update.insert(0, self._sparse_command())
+            sparse = ' '.join(shlex.quote(a) for a in self._sparse_command())
+            clone = f'{clone} && (cd {local} && {sparse})'
+        update_commands = ' && '.join(
+            ' '.join(shlex.quote(a) for a in command) for command in update)
+        self.print(f'if test -d {local}')
+        self.print(f'then (cd {local} && {update_commands})')
+        self.print(f'else {clone}')
+        self.print('fi')
         return True
 
-    def _clone(self) -> bool:
-        return self._run(['git', 'clone', str(self.remote), str(self.local)])
+    @property
+    def clone_filter(self) -> str | None:
+        """Partial clone filter, such as `blob:none` or `tree:0`."""
+        value = self.options.get('filter')
+        if value and not isinstance(value, str):
+            raise ValueError('filter must be a string')
+        return value or None
+
+    @property
+    def depth(self) -> int | None:
+        """Number of commits to fetch, for a shallow clone."""
+        value = self.options.get('depth')
+        if value is None:
+            return None
+        try:
+            depth = int(value)
+        except (TypeError, ValueError):
+            depth = 0
+        if depth < 1:
+            raise ValueError('depth must be a positive integer')
+        return depth
+
+    @property
+    def shallow(self) -> bool:
+        """Whether the local copy is a shallow clone."""
+        return self.local.joinpath('.git', 'shallow').exists()
+
+    def _clone_options(self) -> list[str]:
+        """Options for cloning from the remote."""
+        options = []
+        if clone_filter := self.clone_filter:
+            options.append(f'--filter={clone_filter}')
+        if depth := self.depth:
+            options += ['--depth', str(depth)]
+        options += self._branch_options()
+        if self.sparse is not None:
+            options.append('--sparse')
+        return options
+
+    def _branch_options(self) -> list[str]:
+        """Options for which branches to clone."""
+        options = []
+        if branch := self.options.get('branch'):
+            options += ['--branch', str(branch)]
+        single_branch = self.options.get('single_branch')
+        if single_branch is not None:
+            options.append('--single-branch' if option_bool(single_branch)
+                           else '--no-single-branch')
+        return options
+
+    @property
+    def sparse(self) -> list[str] | None:
+        """Directories for a cone-mode sparse checkout."""
+        value = self.options.get('sparse')
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not all(
+                isinstance(v, str) for v in value):
+            raise ValueError('sparse must be a directory or list of them')
+        return [self.options.expand(v).strip('/') for v in value]
+
+    def check_options(self) -> None:
+        _ = self.clone_filter, self.depth, self.sparse
+
+    def _fingerprint(self, reader: GitReader) -> dict[str, Any] | None:
+        """
+        Stat information that changes when the working tree probably does.
+
+        This covers HEAD, the index, and the modification times of the
+        working tree's top level and the entries in it, so it misses
+        changes to files below the top level, other than additions and
+        removals in top-level directories.
+        """
+        try:
+            index = os.stat(reader.git / 'index')
+            tree = {'.': os.stat(self.local).st_mtime_ns}
+            with os.scandir(self.local) as entries:
+                for entry in entries:
+                    if entry.name != '.git':
+                        tree[entry.name] = entry.stat(
+                            follow_symlinks=False).st_mtime_ns
+        except OSError:
+            return None
+        return {
+            'head': reader.head,
+            'index': [index.st_mtime_ns, index.st_size],
+            'tree': tree,
+        }
+
+    def _reader(self) -> GitReader | None:
+        """Read the local repository directly, if it is simple enough."""
+        try:
+            return GitReader(self.local)
+        except ValueError:
+            return None
+
+    def _sparse_command(self) -> list[str]:
+        return ['git', 'sparse-checkout', 'set', '--cone', *(self.sparse or [])]
+
+    def _sparse_current(self) -> Steps[bool]:
+        """Whether the local copy has the configured sparse checkout."""
+        sparse = self.sparse
+        if sparse is None:
+            return True
+        p = yield from self._runp(['git', 'sparse-checkout', 'list'],
+                                  cwd=self.local)
+        return p.returncode == 0 and p.stdout.splitlines() == sparse
+
+    def _sync_sparse(self, *, check: bool) -> Steps[bool]:
+        """Apply the configured sparse checkout, unless `check` finds it."""
+        if self.sparse is None:
+            return True
+        if check and (yield from self._sparse_current()):
+            return True
+        return (yield from self._run(self._sparse_command(), cwd=self.local))
+
+    def _fetch_command(self, *, shallow: bool) -> list[str]:
+        """Command, run in the local copy, to fetch from the remote."""
+        fetch = ['git', 'fetch']
+        if clone_filter := self.clone_filter:
+            fetch.append(f'--filter={clone_filter}')
+        if shallow and (depth := self.depth):
+            fetch.extend(['--depth', str(depth)])
+        return fetch
+
+    def _integrate_command(self, *, shallow: bool) -> list[str]:
+        """Command, run in the local copy, to apply fetched changes."""
+        if shallow and self.depth:
+            # Rebasing would need the history that a shallow clone lacks,
+            # so move to the new upstream head, keeping local changes.
+            return ['git', 'reset', '--keep', '@{upstream}']
+        return ['git', 'rebase']
+
+    def _update_commands(self, *, shallow: bool) -> list[list[str]]:
+        """Commands, run in the local copy, to update from the remote."""
+        fetch = self._fetch_command(shallow=shallow)
+        if len(fetch) > 2:
+            # Unlike `pull`, `fetch` takes a filter; this also converts a
+            # full clone to a partial one.
+            return [fetch, self._integrate_command(shallow=shallow)]
+        return [['git', 'pull', '--rebase']]
+
+    def _deepen(self) -> Steps[bool]:
+        if not self.shallow:
+            return True
+        return (yield from self._run(['git', 'fetch', '--unshallow'],
+                                     cwd=self.local))
+
+    @property
+    def mirror(self) -> Path | None:
+        cache = self.options.get('CACHE_HOME')
+        if not cache or not option_bool(self.options.get('mirror', False)):
+            return None
+        remote = str(self.remote).rstrip('/')
+        stem = re.sub(r'[^\w.-]+', '_', remote.rpartition('/')[2])
+        digest = hashlib.sha256(self.source_key.encode()).hexdigest()[: 16]
+        return Path(cache, 'gepare', 'mirror',
+                    f'{stem.removesuffix(".git")}-{digest}.git')
+
+    def _update_mirror(self) -> Steps[bool]:
+        mirror = self.mirror
+        if mirror is None:
+            return True
+        if mirror.exists():
+            return (yield from self._run(['git', 'fetch', '--prune', 'origin'],
+                                         cwd=mirror))
+        mirror.parent.mkdir(parents=True, exist_ok=True)
+        return (yield from self._run(
+            ['git', 'clone', '--mirror',
+             str(self.remote), str(mirror)]))
+
+    @property
+    def shareable(self) -> bool:
+        # A clone from a peer has all of its history and branches.
+        return self.mirror is None and not (
+            self.depth or self.clone_filter
+            or option_bool(self.options.get('single_branch')))
+
+    def _local_peer(self) -> 'GitOrigin | None':
+        """The peer to fetch from, unless its local copy is shallow."""
+        peer = self.peer
+        if isinstance(peer, GitOrigin) and not peer.shallow:
+            return peer
+        return None
+
+    def _clone(self) -> Steps[bool]:
+        if not (yield from self._clone_source()):
+            return False
+        return (yield from self._sync_sparse(check=False))
 
-    def _update(self) -> bool:
-        return self._run(['git', 'pull', '--rebase'], cwd=self.local)
+    def _update(self) -> Steps[bool]:
+        # Adjust the sparse checkout first, so that updating does not
+        # check out unwanted files.
+        if not (yield from self._sync_sparse(check=True)):
+            return False
+        return (yield from self._update_source())
+
+    def _fetch(self) -> Steps[OriginStatus]:
+        if (peer := self._local_peer()) is not None:
+            fetched = yield from self._fetch_from(peer.local, PEER_REFSPEC)
+        elif (mirror := self.mirror) is not None:
+            if not mirror.exists() and not (yield from self._update_mirror()):
+                return OriginStatus.ERROR
+            fetched = yield from self._fetch_from(mirror, MIRROR_REFSPEC)
+        else:
+            fetched = yield from self._run(
+                self._fetch_command(shallow=self.shallow), cwd=self.local)
+        if not fetched:
+            return OriginStatus.ERROR
+        if not (yield from self._sparse_current()):
+            # Changing the sparse checkout is left to `_integrate()`.
+            return OriginStatus.UPGRADABLE
+        reader = self._reader()
+        if reader is not None and (tracking := reader.tracking_ref()):
+            upstream = reader.resolve(tracking)
+            if upstream is not None and upstream == reader.head:
+                return OriginStatus.UNCHANGED
+        # Nothing to integrate if HEAD already contains the upstream head.
+        p = yield from self._runp(
+            ['git', 'merge-base', '--is-ancestor', '@{upstream}', 'HEAD'],
+            cwd=self.local)
+        return OriginStatus.UNCHANGED if p.returncode == 0 else (
+            OriginStatus.UPGRADABLE)
+
+    def _integrate(self) -> Steps[bool]:
+        # As in `_update()`, so as not to check out unwanted files.
+        if not (yield from self._sync_sparse(check=True)):
+            return False
+        return (yield from self._run(
+            self._integrate_command(shallow=self.shallow), cwd=self.local))
+
+    def _clone_source(self) -> Steps[bool]:
+        if (peer := self._local_peer()) is not None:
+            return (yield from self._clone_from(peer.local, PEER_REFSPEC))
+        mirror = self.mirror
+        if mirror is None:
+            return (yield from self._run([
+                'git', 'clone', *self._clone_options(),
+                str(self.remote),
+                str(self.local)
+            ]))
+        if not mirror.exists() and not (yield from self._update_mirror()):
+            return False
+        return (yield from self._clone_from(mirror, None))
+
+    def _update_source(self) -> Steps[bool]:
+        if (peer := self._local_peer()) is not None:
+            return (yield from self._update_from(peer.local, PEER_REFSPEC))
+        mirror = self.mirror
+        if mirror is None:
+            for command in self._update_commands(shallow=self.shallow):
+                if not (yield from self._run(command, cwd=self.local)):
+                    return False
+            return True
+        if not mirror.exists() and not (yield from self._update_mirror()):
+            return False
+        return (yield from self._update_from(mirror, MIRROR_REFSPEC))
+
+    def _clone_from(self, source: Path, refspec: str | None) -> Steps[bool]:
+        """
+        Clone from a local copy of the remote.
+
+        A bare mirror (with `refspec` of `None`) has the remote's branches;
+        its objects are copied (with `--dissociate`), so that clearing the
+        cache, or pruning the mirror, leaves the clone intact. From another
+        clone, the remote branches are fetched using `refspec`, and the
+        upstream branch is checked out, so that none of its local commits
+        are taken.
+        Either way, the clone is pointed at the real remote.
+        """
+        options = []
+        if refspec is None:
+            options += [
+                '--reference',
+                str(source), '--dissociate', *self._branch_options()
+            ]
+        else:
+            options.append('--no-checkout')
+        if self.sparse is not None:
+            options.append('--sparse')
+        cloned = yield from self._run(
+            ['git', 'clone', *options,
+             str(source), str(self.local)])
+        if not cloned:
+            return False
+        if not (yield from self._run(
+                ['git', 'remote', 'set-url', 'origin',
+                 str(self.remote)],
+                cwd=self.local)):
+            return False
+        if refspec is None:
+            return True
+        if not (yield from self._fetch_from(source, refspec)):
+            return False
+        return (yield from self._checkout_upstream(source))
+
+    def _checkout_upstream(self, source: Path) -> Steps[bool]:
+        """
+        Check out the configured `branch`, or else the one `source` tracks.
+
+        The clone's own branch, copied from `source`, is replaced.
+        """
+        cloned = yield from self._branch(self.local, upstream=False)
+        branch = self.options.get('branch')
+        if not branch:
+            branch = yield from self._branch(source, upstream=True)
+        if not branch:
+            branch = cloned
+        if not branch:
+            self.error(f'{source} has no branch to check out.')
+            return False
+        if not (yield from self._run(
+                ['git', 'checkout', '--track', '-B', branch,
+                 f'origin/{branch}'],
+                cwd=self.local)):
+            return False
+        if cloned is None or cloned == branch:
+            return True
+        return (yield from self._run(['git', 'branch', '-D', cloned],
+                                     cwd=self.local))
 
-    def _status(self) -> OriginStatus:
-        p = self._runp(['git', 'status', '--porcelain=2'], cwd=self.local)
+    def _branch(self, repo: Path, *, upstream: bool) -> Steps[str | None]:
+        """The current branch of a local copy, or the remote one it tracks."""
+        try:
+            reader = GitReader(repo)
+        except ValueError:
+            reader = None
+        if reader is not None:
+            if upstream:
+                tracked = reader.upstream()
+                ref = tracked[1] if tracked and tracked[0] != '.' else None
+            else:
+                ref = reader.head_ref
+            return ref.removeprefix('refs/heads/') if ref else None
+        if upstream:
+            command = ['git', 'rev-parse', '--abbrev-ref', '@{upstream}']
+        else:
+            command = ['git', 'symbolic-ref', '--quiet', '--short', 'HEAD']
+        p = yield from self._runp(command, cwd=repo)
+        name = p.stdout.strip()
+        if p.returncode or not name:
+            return None
+        # The upstream is named `REMOTE/BRANCH`.
+        return name.partition('/')[2] if upstream else name
+
+    def _fetch_from(self, source: Path, refspec: str) -> Steps[bool]:
+        """Fetch remote branches from a local copy, failing on any refusal."""
+        p = yield from self._runp(
+            ['git', 'fetch', '--prune', str(source), refspec], cwd=self.local)
+        self._report(p)
         if p.returncode:
-            return OriginStatus.ERROR
-        if p.stdout:
-            return OriginStatus.DIRTY
-        # TODO check remote: separate local status from upgradability?
-        return OriginStatus.UNKNOWN
+            return False
+        # Git can refuse to update some refs, as from a shallow source,
+        # and still succeed.
+        if '[rejected]' in p.stderr or 'warning: rejected ' in p.stderr:
+            self.error(f'could not update all branches from {source}.')
+            return False
+        return True
+
+    def _update_from(self, source: Path, refspec: str) -> Steps[bool]:
+        """Fetch remote branches from a local copy, and rebase."""
+        if not (yield from self._fetch_from(source, refspec)):
+            return False
+        return (yield from self._run(['git', 'rebase'], cwd=self.local))
+
+    def _status(self) -> Steps[OriginStatus]:
+        reader = self._reader()
+        key = os.path.abspath(self.local)
+        # Take the fingerprint before scanning, so that changes made during
+        # the scan are noticed next time.
+        fingerprint = None
+        if reader is not None and self.stats is not None:
+            fingerprint = self._fingerprint(reader)
+        branch: dict[str, str] = {}
+        if (fingerprint is None or self.stats is None
+                or not self.stats.clean(key, fingerprint)):
+            command = ['git', 'status', '--porcelain=2']
+            if reader is None:
+                command.append('--branch')
+            p = yield from self._runp(command, cwd=self.local)
+            if p.returncode:
+                return OriginStatus.ERROR
+            dirty = False
+            for line in p.stdout.splitlines():
+                if not line.startswith('# '):
+                    dirty = True
+                    break
+                k, _, v = line[2 :].partition(' ')
+                branch[k] = v
+            if self.stats is not None:
+                self.stats.put(key, None if dirty else fingerprint)
+            if dirty:
+                return OriginStatus.DIRTY
+        if reader is None:
+            head = branch.get('branch.oid', '(initial)')
+            upstream = branch.get('branch.upstream')
+            # The upstream is named `REMOTE/BRANCH`.
+            ref = 'refs/heads/' + upstream.partition('/')[2] if upstream else ''
+        else:
+            head = reader.head or '(initial)'
+            tracked = reader.upstream()
+            ref = tracked[1] if tracked and tracked[0] != '.' else ''
+        if head == '(initial)' or not ref:
+            return OriginStatus.UNKNOWN
+        refs = yield from self._remote_refs()
+        remote_head = refs.get(ref) if refs else None
+        if not remote_head:
+            return OriginStatus.UNKNOWN
+        if remote_head == head:
+            return OriginStatus.UNCHANGED
+        # If the remote head is already contained in HEAD, there is nothing
+        # to pull. This also fails if the remote head is not present locally.
+        p = yield from self._runp(
+            ['git', 'merge-base', '--is-ancestor', remote_head, head],
+            cwd=self.local)
+        return OriginStatus.UNCHANGED if p.returncode == 0 else (
+            OriginStatus.UPGRADABLE)
+
+    def _probe(self) -> Steps[dict[str, str] | None]:
+        # Never wait for credentials; a probe that needs them fails instead.
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        p = yield from self._runp(
+            ['git', 'ls-remote', '--heads', str(self.remote)], env=env)
+        if p.returncode:
+            self._report(p)
+            return None
+        refs = {}
+        for line in p.stdout.splitlines():
+            sha, _, ref = line.partition('\t')
+            refs[ref] = sha
+        return refs
+
+class HgCommandServer:
+    """
+    A Mercurial command server for one repository.
+
+    Mercurial is slow to start, so running several commands in one server
+    (`hg serve --cmdserver pipe`) saves time.
+
+    The server's own error output goes to an unlinked temporary file, and is
+    returned with the output of the command during which it appeared.
+    """
+
+    def __init__(self, cwd: Path) -> None:
+        with tempfile.NamedTemporaryFile(
+                prefix='gepare-hg-', delete=False) as f:
+            path = f.name
+        try:
+            self.errors = open(path, 'rb')
+            try:
+                with open(path, 'ab') as log:
+                    self.process = subprocess.Popen(
+                        ['hg', 'serve', '--cmdserver', 'pipe'],
+                        cwd=cwd,
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=log)
+            except OSError:
+                self.errors.close()
+                raise
+        finally:
+            os.unlink(path)
+        self.encoding = 'utf-8'
+        try:
+            channel, hello = self._receive()
+        except EOFError:
+            self.close()
+            raise
+        fields = dict(
+            line.partition(': ')[:: 2]
+            for line in hello.decode('ascii', 'replace').splitlines())
+        if channel != b'o' or 'runcommand' not in fields.get(
+                'capabilities', '').split():
+            self.close()
+            raise OSError(f'unexpected command server greeting {hello!r}')
+        self.encoding = fields.get('encoding', self.encoding)
+
+    def run(self, args: Sequence[str]) -> subprocess.CompletedProcess:
+        """Run an `hg` command line in the server."""
+        data = '\0'.join(args[1 :]).encode(self.encoding)
+        self._send(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        output: dict[bytes, list[bytes]] = {b'o': [], b'e': []}
+        while True:
+            channel, data = self._receive()
+            if channel in (b'I', b'L'):
+                # Commands get no input, as if from `/dev/null`.
+                self._send(struct.pack('>I', 0))
+            elif channel == b'r':
+                returncode = struct.unpack('>i', data)[0]
+                break
+            elif channel in output:
+                output[channel].append(data)
+            elif channel.isupper():
+                raise OSError(
+                    f'unsupported command server channel {channel!r}')
+        output[b'e'].append(self.errors.read())
+        stdout, stderr = (
+            b''.join(output[c]).decode(self.encoding, 'replace')
+            for c in (b'o', b'e'))
+        return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+
+    def close(self) -> None:
+        """Stop the server."""
+        if self.process.stdin:
+            self.process.stdin.close()
+        self.process.wait()
+        self.errors.close()
+
+    def _send(self, data: bytes) -> None:
+        assert self.process.stdin
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _receive(self) -> tuple[bytes, bytes]:
+        channel, length = struct.unpack('>cI', self._read(5))
+        if channel in (b'I', b'L'):
+            # Input requests carry a size, not data.
+            return channel, b''
+        return channel, self._read(length)
+
+    def _read(self, n: int) -> bytes:
+        assert self.process.stdout
+        data = self.process.stdout.read(n)
+        if len(data) < n:
+            errors = self.errors.read().decode(self.encoding, 'replace').strip()
+            raise EOFError(f'command server exited: {errors}'
+                           if errors else 'command server exited')
+        return data
 
 class MercurialOrigin(Origin, name='hg'):
     """A package under Mercurial version control with a remote master."""
 
+    def __init__(self,
+                 name: str,
+                 remote: str | Path,
+                 local: Path,
+                 options: Expander | None = None) -> None:
+        super().__init__(name, remote, local, options)
+        # Whether to run commands in the local repository through a
+        # command server, started when first needed.
+        self.cmdserver = option_bool(self.options.get('cmdserver', False))
+        self.server: HgCommandServer | None = None
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def _serves(self, command: Command) -> bool:
+        """Whether `command` can run in the command server."""
+        return (self.cmdserver and command.args[0] == 'hg'
+                and command.kwargs == {'cwd': self.local})
+
+    def _execute(self, command: Command) -> subprocess.CompletedProcess:
+        if not self._serves(command):
+            return super()._execute(command)
+        try:
+            if self.server is None:
+                self.server = HgCommandServer(self.local)
+            return self.server.run(command.args)
+        except (OSError, EOFError) as e:
+            self.error(f'command server failed: {e}.')
+            self.close()
+            self.cmdserver = False
+            return super()._execute(command)
+
+    async def _aexecute(self,
+                        command: Command) -> subprocess.CompletedProcess:
+        if not self._serves(command):
+            return await super()._aexecute(command)
+        # The server protocol is synchronous; keep it off the event loop.
+        return await asyncio.to_thread(self._execute, command)
+
     def _check(self) -> bool:
         if not self.check_local_is_dir():
             return False
-        if not self.local.joinpath('.hg').is_dir():
-            error(f'{self.name}: {self.local} is not a Mercurial repository.')
+        if not self._is_dir(self.local / '.hg'):
+            self.error(f'{self.local} is not a Mercurial repository.')
             return False
         # TODO: check that the primary remote matches `self.src`.
         return True
 
+    def probe_paths(self) -> list[Path]:
+        return [self.local, self.local / '.hg']
+
+    def head(self) -> str | None:
+        # The dirstate starts with the working directory's parent.
+        try:
+            with open(self.local / '.hg' / 'dirstate', 'rb') as f:
+                node = f.read(20)
+        except OSError:
+            return None
+        return node.hex() if len(node) == 20 else None
+
+    def size(self) -> int | None:
+        # The changelog and manifest grow with the history.
+        size = 0
+        for name in ('changelog', 'manifest'):
+            for ext in ('i', 'd'):
+                try:
+                    size += os.stat(self.local / '.hg' / 'store' /
+                                    f'00{name}.{ext}').st_size
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    return None
+        return size or None
+
     def _bootstrap(self) -> bool:
         local = shell_escape(str(self.local))
-        print(f'if test -d {local}')
-        print(f'then (cd {local} && hg pull -u)')
-        print(f'else hg clone {shell_escape(str(self.remote))} {local}')
-        print('fi')
+        self.print(f'if test -d {local}')
+        self.print(f'then (cd {local} && hg pull -u)')
+        self.print(f'else hg clone {shell_escape(str(self.remote))} {local}')
+        self.print('fi')
         return True
 
-    def _clone(self) -> bool:
-        return self._run(['hg', 'clone', str(self.remote), str(self.local)])
+    @property
+    def shareable(self) -> bool:
+        return True
 
-    def _update(self) -> bool:
-        return self._run(['hg', 'pull', '-u'], cwd=self.local)
+    def _clone(self) -> Steps[bool]:
+        if self.peer is None:
+            return (yield from self._run(
+                ['hg', 'clone', str(self.remote), str(self.local)]))
+        if not (yield from self._run(
+            ['hg', 'clone', str(self.peer.local),
+             str(self.local)])):
+            return False
+        # Point the clone at the real remote.
+        try:
+            self.local.joinpath('.hg', 'hgrc').write_text(
+                f'[paths]\ndefault = {self.remote}\n', encoding='utf-8')
+        except OSError as e:
+            self.error(f'could not set default path: {e}.')
+            return False
+        return True
 
-    def _status(self) -> OriginStatus:
-        # TODO return status
-        self._run(['hg', 'status'], cwd=self.local)
-        return OriginStatus.UNKNOWN
+    def _update(self) -> Steps[bool]:
+        command = ['hg', 'pull', '-u']
+        if self.peer is not None:
+            command.append(str(self.peer.local))
+        return (yield from self._run(command, cwd=self.local))
+
+    def _fetch(self) -> Steps[OriginStatus]:
+        command = ['hg', 'pull']
+        if self.peer is not None:
+            command.append(str(self.peer.local))
+        if not (yield from self._run(command, cwd=self.local)):
+            return OriginStatus.ERROR
+        if (yield from self._updatable()):
+            return OriginStatus.UPGRADABLE
+        return OriginStatus.UNCHANGED
+
+    def _integrate(self) -> Steps[bool]:
+        return (yield from self._run(['hg', 'update'], cwd=self.local))
+
+    @property
+    def probe_key(self) -> str:
+        # Incoming changes depend on the local repository too.
+        return f'{self.source_key}#{self.local}'
+
+    def _probe(self) -> Steps[dict[str, str] | None]:
+        # Maps each branch to its newest incoming changeset.
+        command = [
+            'hg', 'incoming', '--quiet', '--config', 'ui.interactive=false',
+            '--template', '{node} {branch}\n',
+            str(self.remote)
+        ]
+        p = yield from self._runp(command, cwd=self.local)
+        # `hg incoming` exits with 1 if there are no incoming changes.
+        if p.returncode > 1:
+            self._report(p)
+            return None
+        refs = {}
+        for line in p.stdout.splitlines():
+            node, _, branch = line.partition(' ')
+            refs[branch] = node
+        return refs
+
+    def _status(self) -> Steps[OriginStatus]:
+        # Unlike `hg status`, `hg identify` does not list changed files.
+        p = yield from self._runp(['hg', 'identify', '--template', 'json'],
+                                  cwd=self.local)
+        if p.returncode:
+            self._report(p)
+            return OriginStatus.ERROR
+        try:
+            [identity] = json.loads(p.stdout)
+            dirty = identity['dirty']
+            branch = identity['branch']
+        except (ValueError, TypeError, KeyError):
+            self.error(f'unexpected identify output {p.stdout!r}.')
+            return OriginStatus.ERROR
+        if dirty:
+            return OriginStatus.DIRTY
+        refs = yield from self._remote_refs()
+        if refs is None:
+            return OriginStatus.UNKNOWN
+        # Changesets already pulled, but not checked out.
+        if (yield from self._updatable()):
+            return OriginStatus.UPGRADABLE
+        # A cached incoming changeset may have been pulled since.
+        node = refs.get(branch)
+        if node and not (yield from self._has_revs(f'id({node})')):
+            return OriginStatus.UPGRADABLE
+        return OriginStatus.UNCHANGED
+
+    def _updatable(self) -> Steps[bool]:
+        """Whether `hg update` would check out a newer changeset."""
+        # It moves to the newest descendant on the same branch.
+        return (yield from self._has_revs(
+            'descendants(.) and branch(.) and not .'))
+
+    def _has_revs(self, revs: str) -> Steps[bool]:
+        """Whether the revset `revs` is non-empty in the local repository."""
+        p = yield from self._runp(
+            ['hg', 'log', '--limit', '1', '--template', '{node}\n', '-r', revs],
+            cwd=self.local)
+        return p.returncode == 0 and bool(p.stdout.strip())
 
 class SymlinkOrigin(Origin, name='ln'):
     """A package symbolically linked to a master local directory."""
 
-    def __init__(self, name: str, remote: str | Path, local: Path) -> None:
-        super().__init__(name, remote, local)
+    def __init__(self,
+                 name: str,
+                 remote: str | Path,
+                 local: Path,
+                 options: Expander | None = None) -> None:
+        super().__init__(name, remote, local, options)
         self.src: Path = Path(remote)
 
     def _check(self) -> bool:
         if not self.check_local_is_dir():
             return False
-        if not self.local.is_symlink():
-            error(f'{self.name}: {self.local} is not a symbolic link.')
+        if not self._is_symlink(self.local):
+            self.error(f'{self.local} is not a symbolic link.')
             return False
         if self.local.resolve() != self.src.resolve():
-            error(f'{self.name}: {self.local} does not point to {self.src}')
+            self.error(f'{self.local} does not point to {self.src}')
             return False
         return True
 
     def _bootstrap(self) -> bool:
         local = shell_escape(str(self.local))
-        print(f'test -d {local} ||'
-              f' ln -s {shell_escape(str(self.remote))} {local}')
+        self.print(f'test -d {local} ||'
+                   f' ln -s {shell_escape(str(self.remote))} {local}')
         return True
 
     def _clone(self) -> bool:
-        self.src.symlink_to(self.local)
+        try:
+            self.local.symlink_to(self.src)
+        except OSError as e:
+            self.error(f'{self.local} could not be linked: {e}.')
+            return False
+        return True
 
     def _update(self) -> bool:
-        pass
+        return True
 
     def _status(self) -> OriginStatus:
         return OriginStatus.UNCHANGED
 
-@dataclass
+# Packages refer to each other, so compare them by identity.
+@dataclass(eq=False)
 class Package:
     """Package information."""
 
     name: str
     origin: Origin
     info: Expander
+    # The package whose origin this one fetches from; see `deduplicate()`.
+    peer: 'Package | None' = None
+    # Packages that must be operated on before this one; see `link_after()`.
+    after: list['Package'] = field(default_factory=list)
+
+    @property
+    def key(self) -> str:
+        """The package's configuration key, which, unlike `name`, is unique."""
+        return str(self.info.get('key', self.name))
+
+    def predecessors(self) -> list['Package']:
+        """Packages that must finish before this one starts."""
+        return [*self.after, self.peer] if self.peer else self.after
+
+@dataclass
+class HostLimits:
+    """Limits on concurrent origin operations per network host."""
+
+    default: int | None = None
+    hosts: dict[str, int] = field(default_factory=dict)
+
+    def limit(self, host: str) -> int | None:
+        if not host:
+            return None
+        return self.hosts.get(host, self.default)
+
+    @classmethod
+    def from_config(cls, ginfo: Expander, config: Mapping[str, Any]) -> Self:
+        """Read `max_per_host` from `[global]` and `[host.NAME]` tables."""
 
-def read_toml(files: Iterable) -> dict[str, Any]:
-    data: dict[str, Any] = {}
+        def check(where: str, value: Any) -> int:
+            try:
+                n = int(value)
+            except (TypeError, ValueError):
+                n = 0
+            if n < 1:
+                raise ValueError(f'{where}: max_per_host must be at least 1')
+            return n
+
+        limits = cls()
+        default = ginfo.get('max_per_host')
+        if default is not None:
+            limits.default = check('global', default)
+        for host, table in config.get('host', {}).items():
+            value = table.get('max_per_host')
+            if value is not None:
+                limits.hosts[host.lower()] = check(f'host.{host}', value)
+        return limits
+
+def run_jobs(packages: Iterable[Package],
+             work: Callable[[Package], bool],
+             jobs: int = 1,
+             limits: HostLimits | None = None,
+             after: Callable[[Package], Iterable[Package]] | None = None,
+             priority: Callable[[Package], float] | None = None,
+             ) -> bool:
+    """
+    Run `work` for each package using up to `jobs` worker threads.
+
+    Packages start in order, or in order of decreasing `priority` if given,
+    except that a package whose host is at its limit, or which must run
+    `after` packages that have not finished, waits while later packages go
+    ahead of it.
+
+    Output from each package's origin is collected while it runs, and
+    written in package order once it finishes, so the result does not
+    depend on scheduling. Returns whether all packages succeeded.
+    """
+    if limits is None:
+        limits = HostLimits()
+    order = list(packages)
+    pending = list(order)
+    if priority is not None:
+        pending.sort(key=priority, reverse=True)
+    ids = {id(package) for package in order}
+    running: dict[Future, Package] = {}
+    finished: dict[int, Future] = {}
+    active: Counter[str] = Counter()
+    emitted = 0
+    ok = True
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            i = 0
+            while len(running) < jobs and i < len(pending):
+                package = pending[i]
+                host = package.origin.host
+                limit = limits.limit(host)
+                if (limit is not None and active[host] >= limit) or (
+                        after is not None and any(
+                            id(p) in ids and id(p) not in finished
+                            for p in after(package))):
+                    i += 1
+                    continue
+                del pending[i]
+                active[host] += 1
+                package.origin.stdout = io.StringIO()
+                package.origin.stderr = io.StringIO()
+                running[executor.submit(work, package)] = package
+            if not running:
+                raise RuntimeError('circular package dependencies')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                package = running.pop(future)
+                active[package.origin.host] -= 1
+                finished[id(package)] = future
+            while emitted < len(order) and id(order[emitted]) in finished:
+                package = order[emitted]
+                emitted += 1
+                try:
+                    ok = finished[id(package)].result() and ok
+                finally:
+                    origin = package.origin
+                    assert isinstance(origin.stdout, io.StringIO)
+                    assert isinstance(origin.stderr, io.StringIO)
+                    sys.stdout.write(origin.stdout.getvalue())
+                    sys.stderr.write(origin.stderr.getvalue())
+                    origin.stdout = None
+                    origin.stderr = None
+    return ok
+
+def predict_makespan(costs: Iterable[float], jobs: int) -> float:
+    """Predict the time to run jobs, longest first, on `jobs` workers."""
+    workers = [0.0] * jobs
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(workers, workers[0] + cost)
+    return max(workers)
+
+def probe_remotes(packages: Iterable[Package],
+                  jobs: int = 1,
+                  limits: HostLimits | None = None) -> bool:
+    """
+    Read remote refs for existing packages, once per distinct probe key
+    (normally, once per source).
+
+    The results are kept in each origin's `refs`, which should be shared,
+    for later use by `Origin.status()`.
+    """
+    probes: dict[str, Package] = {}
+    for package in packages:
+        if package.origin.local_exists():
+            probes.setdefault(package.origin.probe_key, package)
+    return run_jobs(probes.values(), lambda p: p.origin.probe(), jobs, limits)
+
+def update_mirrors(packages: Iterable[Package],
+                   jobs: int = 1,
+                   limits: HostLimits | None = None) -> bool:
+    """Update each distinct origin mirror once."""
+    mirrors: dict[Path, Package] = {}
+    for package in packages:
+        mirror = package.origin.mirror
+        if mirror is not None:
+            mirrors.setdefault(mirror, package)
+    return run_jobs(mirrors.values(), lambda p: p.origin.update_mirror(),
+                    jobs, limits)
+
+def deduplicate(packages: Iterable[Package]) -> None:
+    """
+    Have packages with the same source fetch from the first such package.
+
+    Each later package gets the first as its `peer`, and must be refreshed
+    after it, so that only the first fetches from the network.
+    """
+    first: dict[str, Package] = {}
+    for package in packages:
+        origin = package.origin
+        if not origin.shareable:
+            continue
+        peer = first.setdefault(origin.source_key, package)
+        # A peer that must come after the package cannot serve it.
+        if peer is not package and not runs_after(peer, package):
+            package.peer = peer
+            origin.peer = peer.origin
+
+def link_after(packages: Mapping[str, Package]) -> None:
+    """
+    Set each package's `after` dependencies.
+
+    These are the packages named by its `after` key, and any package whose
+    `dst` contains its own, so that a nested package is cloned after the
+    enclosing one.
+    """
+    by_dst = {package.origin.local: package for package in packages.values()}
+    for package in packages.values():
+        keys = package.info.get('after', [])
+        if isinstance(keys, str):
+            keys = [keys]
+        if not isinstance(keys, list):
+            raise TypeError(keys)
+        for key in keys:
+            if key in packages:
+                package.after.append(packages[key])
+            else:
+                error(f'{package.name}: unknown package {key} in ‘after’.')
+        for parent in package.origin.local.parents:
+            if parent in by_dst:
+                package.after.append(by_dst[parent])
+                break
+
+def runs_after(package: Package, other: Package) -> bool:
+    """Check whether `package` must wait, directly or not, for `other`."""
+    seen = set()
+    stack = [package]
+    while stack:
+        for p in stack.pop().predecessors():
+            if p is other:
+                return True
+            if id(p) not in seen:
+                seen.add(id(p))
+                stack.append(p)
+    return False
+
+def find_cycle(packages: Iterable[Package]) -> list[Package] | None:
+    """
+    Find a cycle of dependencies among packages, if there is one.
+
+    Returns the packages along the cycle, with the first repeated at the
+    end. Dependencies on packages not in `packages` are ignored.
+    """
+    _, cycle = depth_first(packages, Package.predecessors, id)
+    return cycle
+
+@dataclass
+class Operations:
+    """
+    Repository operations to perform on packages.
+
+    Operations run in two stages. The first does anything that needs the
+    network (cloning, and fetching for updates) with `jobs` workers;
+    the second integrates what was fetched into local copies, and reports
+    status, with `local_jobs` workers. Packages that fetched nothing new
+    skip integration.
+    """
+
+    bootstrap: bool = False
+    deepen: bool = False
+    refresh: bool = False
+    only_upgradable: bool = False
+    status: bool = False
+    jobs: int = 1
+    local_jobs: int = 1
+    limits: HostLimits = field(default_factory=HostLimits)
+    # Shared by the packages' origins, if set, after probing their paths.
+    files: FileTypes | None = None
+    # Where to record each package operation, if set.
+    state: StateStore | None = None
+    # Skip refreshing packages refreshed more recently than this, in
+    # seconds; if `None`, packages' `refresh_interval` applies.
+    max_age: float | None = None
+    # Report status on standard error, leaving standard output for `--json`.
+    json: bool = False
+    # Predicted and actual durations, in seconds, of the first stage of a
+    # refresh, once run.
+    schedule: dict[str, float | None] = field(default_factory=dict)
+    # Results of the first stage, by package `id()`.
+    fetched: dict[int, OriginStatus] = field(default_factory=dict, init=False)
+    # Packages not to refresh, by `id()`; see `_fresh()`.
+    fresh: set[int] = field(default_factory=set, init=False)
+
+    @property
+    def probing(self) -> bool:
+        """Whether the operations need remote refs."""
+        return self.status or (self.refresh and self.only_upgradable)
+
+    def run(self, packages: Sequence[Package]) -> bool:
+        """Perform the operations, returning whether all succeeded."""
+        try:
+            return self._run(packages)
+        finally:
+            for package in packages:
+                package.origin.close()
+
+    def _run(self, packages: Sequence[Package]) -> bool:
+        if self.files is not None:
+            self.files.probe(path for package in packages
+                             for path in package.origin.probe_paths())
+            for package in packages:
+                package.origin.files = self.files
+        ok = True
+        self.fresh = set()
+        if self.refresh:
+            for package in packages:
+                try:
+                    fresh = self._fresh(package)
+                except ValueError as e:
+                    error(f'{package.name}: refresh_interval: {e}')
+                    ok = False
+                    # Skip it, as if it were fresh.
+                    fresh = True
+                if fresh:
+                    self.fresh.add(id(package))
+        stale = [p for p in packages if id(p) not in self.fresh]
+        if self.probing:
+            ok = probe_remotes(packages if self.status else stale, self.jobs,
+                               self.limits) and ok
+        if self.refresh:
+            ok = update_mirrors(stale, self.jobs, self.limits) and ok
+            deduplicate(packages)
+        self.fetched = {}
+        if self.bootstrap or self.deepen or self.refresh:
+            costs: dict[int, float] = {}
+            predictable = False
+            if self.refresh:
+                costs, predictable = self._costs(packages)
+            start = time.monotonic()
+            ok = run_jobs(packages, self._fetch_stage, self.jobs, self.limits,
+                          Package.predecessors,
+                          (lambda p: costs[id(p)]) if costs else None) and ok
+            if self.refresh:
+                self.schedule = {
+                    'predicted':
+                        predict_makespan(costs.values(), self.jobs)
+                        if predictable else None,
+                    'actual': time.monotonic() - start,
+                }
+        second = [
+            p for p in packages if self.status
+            or self.fetched.get(id(p)) == OriginStatus.UPGRADABLE
+        ]
+        if second:
+            ok = run_jobs(second, self._integrate_stage, self.local_jobs,
+                          None, Package.predecessors) and ok
+        return ok
+
+    def _fetch_stage(self, package: Package) -> bool:
+        origin = package.origin
+        peer = package.peer
+        if (peer is not None
+                and self.fetched.get(id(peer)) == OriginStatus.ERROR):
+            # Fall back to fetching from the remote.
+            package.peer = None
+            origin.peer = None
+        ok = True
+        if self.bootstrap:
+            ok = self._record(package, 'bootstrap', origin.bootstrap) and ok
+        if self.deepen and origin.local_exists():
+            ok = self._record(package, 'deepen', origin.deepen) and ok
+        fetched = OriginStatus.UNCHANGED
+        if self.refresh and id(package) not in self.fresh:
+            if not origin.local_exists():
+                if not self._record(package, 'clone', origin.clone):
+                    fetched = OriginStatus.ERROR
+            elif self.only_upgradable:
+                status = self._record(package, 'status', origin.status)
+                if status == OriginStatus.ERROR:
+                    fetched = status
+                elif status != OriginStatus.UNCHANGED:
+                    fetched = self._record(package, 'fetch', origin.fetch)
+            else:
+                fetched = self._record(package, 'fetch', origin.fetch)
+        self.fetched[id(package)] = fetched
+        return ok and fetched != OriginStatus.ERROR
+
+    def _integrate_stage(self, package: Package) -> bool:
+        origin = package.origin
+        ok = True
+        if self.fetched.get(id(package)) == OriginStatus.UPGRADABLE:
+            ok = self._record(package, 'integrate', origin.integrate)
+        if self.status:
+            status = self._record(package, 'status', origin.status)
+            line = f'{package.name}: {status.name.lower()}'
+            if self.json:
+                print(line, file=origin.stderr or sys.stderr)
+            else:
+                origin.print(line)
+            ok = status != OriginStatus.ERROR and ok
+        return ok
+
+    def _costs(self,
+               packages: Sequence[Package]) -> tuple[dict[int, float], bool]:
+        """
+        Expected durations of the first stage, by package `id()`.
+
+        Durations recorded in `state` are used where there are any. Other
+        packages are estimated from the size of their local repositories,
+        at the rate seen for packages with both, or else are given the
+        average. Without any recorded durations, the costs are just sizes,
+        which can order packages but not predict time; the second result
+        tells whether costs are times.
+        """
+        recorded: dict[int, float] = {}
+        sizes: dict[int, int] = {}
+        fresh = set()
+        for package in packages:
+            origin = package.origin
+            if id(package) in self.fresh:
+                fresh.add(id(package))
+                continue
+            operation = 'fetch' if origin.local_exists() else 'clone'
+            if self.state is not None and (duration := self.state.duration(
+                    package.key, operation)) is not None:
+                recorded[id(package)] = duration
+            if size := origin.size():
+                sizes[id(package)] = size
+        costs: dict[int, float] = {}
+        if not recorded:
+            for package in packages:
+                costs[id(package)] = float(sizes.get(id(package), 0))
+            return costs, False
+        both = [i for i in recorded if i in sizes]
+        rate = (sum(recorded[i] for i in both) /
+                sum(sizes[i] for i in both)) if both else None
+        average = statistics.mean(recorded.values())
+        for package in packages:
+            i = id(package)
+            if i in fresh:
+                costs[i] = 0.0
+            elif i in recorded:
+                costs[i] = recorded[i]
+            elif rate is not None and i in sizes:
+                costs[i] = sizes[i] * rate
+            else:
+                costs[i] = average
+        return costs, True
+
+    def _fresh(self, package: Package) -> bool:
+        """
+        Whether a package was refreshed recently enough to skip it.
+
+        A bad `refresh_interval` raises `ValueError`.
+        """
+        max_age = self.max_age
+        if max_age is None:
+            interval = package.info.get('refresh_interval')
+            if interval is None:
+                return False
+            max_age = parse_duration(interval)
+        if self.state is None or not package.origin.local_exists():
+            return False
+        last = self.state.last_refresh(package.key)
+        return last is not None and time.time() - last < max_age
+
+    def _record(self, package: Package, operation: str,
+                action: Callable[[], T]) -> T:
+        """Perform an operation on a package, and record it in `state`."""
+        if self.state is None:
+            return action()
+        origin = package.origin
+        head = origin.head()
+        output = self._output_bytes(origin)
+        started = time.time()
+        start = time.monotonic()
+        result = action()
+        failed = (result == OriginStatus.ERROR if isinstance(
+            result, OriginStatus) else not result)
+        self.state.record(package.key, operation, started,
+                          time.monotonic() - start, int(failed), head,
+                          origin.head(),
+                          self._output_bytes(origin) - output)
+        return result
+
+    @staticmethod
+    def _output_bytes(origin: Origin) -> int:
+        """Bytes of output buffered so far for an origin by `run_jobs()`."""
+        return sum(
+            len(stream.getvalue().encode())
+            for stream in (origin.stdout, origin.stderr)
+            if isinstance(stream, io.StringIO))
+
+def read_toml(files: Iterable, cache: Path | None = None) -> dict[str, Any]:
+    """
+    Read and merge TOML files (names or binary streams).
+
+    With a `cache` directory, the merged result of the leading file names
+    is kept there, and reused while each file's size, modification time
+    and inode are unchanged. Streams, such as `--define` values, are always
+    read, and merged on top.
+    """
+    files = list(files)
+    n = 0
+    while n < len(files) and isinstance(files[n], str | Path):
+        n += 1
+    data: dict[str, Any] | None = None
+    if cache is not None and n:
+        data = read_cached_toml(files[: n], cache)
+    if data is None:
+        data = {}
+    else:
+        files = files[n :]
     for file in files:
         if isinstance(file, str | Path):
             with Path(file).open('rb') as f:
@@ -344,10 +2732,38 @@ def read_toml(files: Iterable) -> dict[str, Any]:
         ndupdate(data, a)
     return data
 
+def read_cached_toml(files: Sequence[str | Path],
+                     cache: Path) -> dict[str, Any] | None:
+    """Read TOML files through a cache, or return None if they can't be."""
+    try:
+        fingerprints = []
+        for file in files:
+            st = os.stat(file)
+            fingerprints.append((os.path.abspath(file), st.st_size,
+                                 st.st_mtime_ns, st.st_ino))
+    except OSError:
+        return None
+    key = '\0'.join(path for path, *_ in fingerprints)
+    path = cache / f'{hashlib.sha256(key.encode()).hexdigest()[:16]}.pickle'
+    try:
+        with open(path, 'rb') as f:
+            saved, data = pickle.load(f)
+        if saved == fingerprints:
+            return data
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    data = read_toml(files)
+    replace_file(
+        path, lambda f: pickle.dump((fingerprints, data), f,
+                                    pickle.HIGHEST_PROTOCOL))
+    return data
+
 def read_inputs(
-        files: Iterable) -> tuple[dict[str, Package], ChainMap, dict[str, Any]]:
+        files: Iterable,
+        cache: Path | None = None,
+) -> tuple[dict[str, Package], ChainMap, dict[str, Any]]:
     """Given filenames, read them all."""
-    config = read_toml(files)
+    config = read_toml(files, cache)
 
     env = dict(os.environ)
     glo: dict[str, Any] = config.get('global', {})
@@ -356,6 +2772,7 @@ def read_inputs(
     glo['STATE_HOME'] = str(xdg_dir('STATE', '.local/state'))
     glo['CACHE_HOME'] = str(xdg_dir('CACHE', '.cache'))
     gcm = ChainMap({'global': glo, 'env': env}, glo, env)
+    ginfo = Expander(gcm)
 
     packages: dict[str, Package] = {}
 
@@ -369,7 +2786,12 @@ def read_inputs(
             template = {}
 
         cm = ChainMap({'package': properties}, properties, template, gcm)
-        info = Expander(cm)
+        info = Expander(cm, ginfo)
+        try:
+            info.evaluate(['load', 'dst', 'src', 'vcs'])
+        except ValueError as e:
+            error(f'{name}: {e}')
+            continue
 
         load = info.get('load', True)
         if isinstance(load, bool | list):
@@ -407,11 +2829,26 @@ def read_inputs(
             error(f'{name}: {vcs} is not a known source type.')
             continue
 
-        origin = vcls(name, src, dst)
+        origin = vcls(name, src, dst, info)
+        try:
+            origin.check_options()
+        except ValueError as e:
+            error(f'{name}: {e}')
+            continue
         packages[key] = Package(name, origin, info)
 
+    link_after(packages)
     return packages, gcm, config
 
+def expand_each(templates: Mapping[str, str], packages: Iterable[Package],
+                ginfo: Expander) -> dict[str, list[str]]:
+    """Expand each of several templates for every package, in order."""
+    scopes = [package.info for package in packages]
+    return {
+        k: Template.compile(template).render_each(scopes, ginfo)
+        for k, template in templates.items()
+    }
+
 def build_output(packages: Mapping[str, Package], ginfo: Expander,
                  config: dict[str, Any]) -> dict[str, Any]:
     output: dict[str, Any] = {}
@@ -422,19 +2859,23 @@ def build_output(packages: Mapping[str, Package], ginfo: Expander,
     for k in gkeys:
         output[k] = ginfo.get(k)
     for k, template in ndget(config, ['output', 'global', 'items'], {}).items():
-        output[k] = template.format_map(ginfo)
+        output[k] = ginfo.expand(template)
     pkeys = ([
         'name', 'src', 'dst', 'vcs', 'load',
         *ndget(config, ['output', 'package', 'keys'], []),
     ])
-    pitems = ndget(config, ['output', 'package', 'items'], {})
+    pitems = expand_each(
+        ndget(config, ['output', 'package', 'items'], {}), packages.values(),
+        ginfo)
     output['package'] = {}
-    for key, package in packages.items():
+    for i, (key, package) in enumerate(packages.items()):
         package_output: dict[str, Any] = {}
         for k in pkeys:
             package_output[k] = package.info.get(k)
-        for k, template in pitems.items():
-            package_output[k] = template.format_map(package.info)
+        for k, values in pitems.items():
+            package_output[k] = values[i]
+        if package.peer is not None:
+            package_output['fetched_from'] = package.peer.info.get('key')
         output['package'][key] = package_output
     return output
 
@@ -445,17 +2886,22 @@ def build_list(variant: str, packages: Mapping[str, Package], ginfo: Expander,
         out.append(str(ginfo.get(k)))
     for template in ndget(config, ['list', variant, 'global', 'items'],
                           {}).values():
-        out.append(template.format_map(ginfo))
+        out.append(ginfo.expand(template))
+    loaded = []
     for package in packages.values():
         load = package.info.get('load')
         if isinstance(load, list):
             load = variant in load
         if load:
-            for k in ndget(config, ['list', variant, 'package', 'keys'], []):
-                out.append(str(package.info.get(k)))
-            for template in ndget(config, ['list', variant, 'package', 'items'],
-                                  {}).values():
-                out.append(template.format_map(package.info))
+            loaded.append(package)
+    pitems = expand_each(
+        ndget(config, ['list', variant, 'package', 'items'], {}), loaded,
+        ginfo)
+    for i, package in enumerate(loaded):
+        for k in ndget(config, ['list', variant, 'package', 'keys'], []):
+            out.append(str(package.info.get(k)))
+        for values in pitems.values():
+            out.append(values[i])
     out.append('')
     return '\n'.join(out)
 
@@ -499,12 +2945,57 @@ def main(argv: Sequence[str] | None = None) -> int:
         action='store_true',
         default=False,
         help='Clone or update packages')
+    parser.add_argument(
+        '--only-upgradable',
+        action='store_true',
+        default=False,
+        help='With --refresh, skip packages that are already up to date')
+    parser.add_argument(
+        '--max-age',
+        metavar='DURATION',
+        type=parse_duration,
+        default=None,
+        help='With --refresh, skip packages refreshed within DURATION')
+    parser.add_argument(
+        '--deepen',
+        action='store_true',
+        default=False,
+        help='Fetch complete history for shallow clones')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        default=False,
+        help='Do not read or write cached remote refs')
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        default=False,
+        help='Probe all remotes, replacing cached remote refs')
     parser.add_argument(
         '--status',
         '-s',
         action='store_true',
         default=False,
         help='Report status of packages')
+    parser.add_argument(
+        '--exact',
+        action='store_true',
+        default=False,
+        help='With --status, scan every local copy for changes')
+    parser.add_argument(
+        '--jobs',
+        '-J',
+        metavar='N',
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f'Run up to N repository operations at once [{DEFAULT_JOBS}]')
+    parser.add_argument(
+        '--local-jobs',
+        metavar='N',
+        type=int,
+        default=DEFAULT_LOCAL_JOBS,
+        help='Run up to N local repository operations, such as rebases,'
+        f' at once [{DEFAULT_LOCAL_JOBS}]')
     parser.add_argument(
         '--json',
         '-j',
@@ -525,6 +3016,10 @@ def main(argv: Sequence[str] | None = None) -> int:
         action='append',
         help='Limit list writing to named variants')
     args = parser.parse_args(argv[1 :])
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.local_jobs < 1:
+        parser.error('--local-jobs must be at least 1')
 
     inputs = list(args.files)
     if args.define:
@@ -532,7 +3027,8 @@ def main(argv: Sequence[str] | None = None) -> int:
             s = f'{k} = "{toml_escape(v)}"'
             inputs.append(io.BytesIO(bytes(s, encoding='utf-8')))
 
-    packages, gcm, config = read_inputs(inputs)
+    packages, gcm, config = read_inputs(
+        inputs, xdg_dir('CACHE', '.cache') / 'gepare' / 'config')
 
     if args.package:
         selected = {}
@@ -543,19 +3039,74 @@ def main(argv: Sequence[str] | None = None) -> int:
                 error(f'{key}: not a configured package.')
         packages = selected
 
-    for package in packages.values():
-        if args.all or package.info.get('load', True):
-            if args.bootstrap:
-                package.origin.bootstrap()
-            if args.refresh:
-                package.origin.refresh()
-            if args.status:
-                package.origin.status()
-
     ginfo = Expander(gcm)
 
+    active = [
+        p for p in packages.values() if args.all or p.info.get('load', True)
+    ]
+    limits = HostLimits()
+    ttl = float(DEFAULT_REF_CACHE_TTL)
+    state = None
+    if args.bootstrap or args.refresh or args.status or args.deepen:
+        if cycle := find_cycle(active):
+            error('circular package dependencies: ' +
+                  ' → '.join(p.name for p in cycle))
+            return 1
+        try:
+            limits = HostLimits.from_config(ginfo, config)
+        except ValueError as e:
+            error(str(e))
+            return 1
+        # Remote refs are only probed for these.
+        if args.status or (args.refresh and args.only_upgradable):
+            value = ginfo.get('ref_cache_ttl')
+            try:
+                ttl = ttl if value is None else parse_duration(value)
+            except ValueError as e:
+                error(f'ref_cache_ttl: {e}')
+                return 1
+        state_db = Path(ginfo['STATE_HOME'], 'gepare', 'state.db')
+        try:
+            state = StateStore(state_db)
+        except (OSError, sqlite3.Error) as e:
+            error(f'{state_db}: {e}')
+    refs = RemoteRefs(
+        None if args.no_cache else Path(ginfo['CACHE_HOME'], 'gepare',
+                                        'refs.json'),
+        ttl,
+        refresh=args.refresh_cache)
+    stats = StatCache(
+        Path(ginfo['STATE_HOME'], 'gepare', 'status.json'), exact=args.exact)
+    for package in active:
+        package.origin.refs = refs
+        package.origin.stats = stats
+
+    operations = Operations(
+        bootstrap=args.bootstrap,
+        deepen=args.deepen,
+        refresh=args.refresh,
+        only_upgradable=args.only_upgradable,
+        status=args.status,
+        jobs=args.jobs,
+        local_jobs=args.local_jobs,
+        limits=limits,
+        files=FileTypes(),
+        state=state,
+        max_age=args.max_age,
+        json=args.json)
+    ok = operations.run(active)
+    if state is not None:
+        state.close()
+    if operations.probing and refs.path is not None:
+        refs.save()
+        print(f'remote ref cache: {refs.hits} hit(s), {refs.misses} miss(es)',
+              file=sys.stderr)
+    stats.save()
+
     if args.json:
         output = build_output(packages, ginfo, config)
+        if operations.schedule:
+            output['schedule'] = operations.schedule
         json.dump(output, sys.stdout, indent=1)
 
     if args.list or args.list_type:
@@ -578,7 +3129,7 @@ def main(argv: Sequence[str] | None = None) -> int:
             with Path(filename).open('w', encoding='utf-8') as f:
                 f.write(build_list(v, packages, ginfo, config))
 
-    return 0
+    return 0 if ok else 1
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))  # pragma: no cover
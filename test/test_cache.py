@@ -0,0 +1,75 @@
+# SPDX-License-Identifier: MIT
+"""Test remote ref cache."""
+
+import json
+import time
+
+import pytest
+
+from gepare import RemoteRefs, parse_duration
+
+REFS = {'refs/heads/main': '1111111111111111111111111111111111111111'}
+
+def test_remote_refs_memory():
+    refs = RemoteRefs()
+    assert 'git:a' not in refs
+    refs.put('git:a', REFS)
+    refs.put('git:b', None)
+    assert 'git:a' in refs
+    assert 'git:b' in refs
+    assert refs.get('git:a') == REFS
+    assert refs.get('git:b') is None
+    assert (refs.hits, refs.misses) == (0, 2)
+
+def test_remote_refs_saved(tmp_path):
+    path = tmp_path / 'gepare' / 'refs.json'
+    refs = RemoteRefs(path, 60)
+    refs.put('git:a', REFS)
+    refs.put('git:b', None)
+    refs.save()
+    assert set(json.loads(path.read_text())) == {'git:a'}
+
+    refs = RemoteRefs(path, 60)
+    assert 'git:a' in refs
+    assert 'git:a' in refs
+    assert 'git:b' not in refs
+    assert refs.get('git:a') == REFS
+    assert (refs.hits, refs.misses) == (1, 0)
+
+def test_remote_refs_expired(tmp_path):
+    path = tmp_path / 'refs.json'
+    path.write_text(json.dumps({
+        'git:a': {'time': time.time() - 120, 'refs': REFS},
+        'git:b': {'time': time.time(), 'refs': REFS},
+    }))
+    refs = RemoteRefs(path, 60)
+    assert 'git:a' not in refs
+    assert 'git:b' in refs
+    refs.put('git:c', REFS)
+    refs.save()
+    assert set(json.loads(path.read_text())) == {'git:b', 'git:c'}
+
+def test_remote_refs_refresh(tmp_path):
+    path = tmp_path / 'refs.json'
+    path.write_text(json.dumps({'git:a': {'time': time.time(), 'refs': {}}}))
+    refs = RemoteRefs(path, 60, refresh=True)
+    assert 'git:a' not in refs
+    refs.put('git:b', REFS)
+    refs.save()
+    assert set(json.loads(path.read_text())) == {'git:a', 'git:b'}
+
+def test_remote_refs_unreadable(tmp_path):
+    path = tmp_path / 'refs.json'
+    path.write_text('{')
+    refs = RemoteRefs(path, 60)
+    assert 'git:a' not in refs
+
+def test_parse_duration():
+    assert parse_duration(90) == 90
+    assert parse_duration('90') == 90
+    assert parse_duration('10m') == 600
+    assert parse_duration('1h 30m') == 5400
+    assert parse_duration('1.5d') == 129600
+    for bad in ('', 'm', '10x', '1h-2m', True):
+        with pytest.raises(ValueError):
+            parse_duration(bad)
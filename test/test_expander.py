@@ -1,7 +1,11 @@
 # SPDX-License-Identifier: MIT
 """Test Expander."""
 
-from gepare import Expander
+from collections import ChainMap
+
+import pytest
+
+from gepare import Expander, Template
 
 EXPANSIONS = {
     'a': 'A',
@@ -33,3 +37,83 @@ def test_expander_contains():
     e = Expander(EXPANSIONS)
     assert 'c' in e
     assert 'd' not in e
+
+def test_expander_cache():
+    e = Expander(EXPANSIONS)
+    assert e['c'] == 'A-A=A-A'
+    assert e.cache['b'][0] == 'A-A'
+    assert e.cache['c'][0] == 'A-A=A-A'
+
+def test_expander_cache_invalidated():
+    d = dict(EXPANSIONS)
+    e = Expander(d)
+    assert e['c'] == 'A-A=A-A'
+    d['a'] = 'Z'
+    assert e['c'] == 'Z-Z=Z-Z'
+    del d['a']
+    assert e.get('c') is None
+
+def test_expander_cache_shadowed():
+    d = dict(EXPANSIONS)
+    cm = ChainMap({}, d)
+    e = Expander(cm)
+    assert e['c'] == 'A-A=A-A'
+    cm.maps[0]['a'] = 'Z'
+    assert e['c'] == 'Z-Z=Z-Z'
+
+def test_expander_cache_mutable():
+    d = {'a': {'x': 'A'}, 'b': '{a[x]}'}
+    e = Expander(d)
+    assert e['b'] == 'A'
+    assert 'b' not in e.cache
+    d['a']['x'] = 'Z'
+    assert e['b'] == 'Z'
+
+def test_expander_cache_parent():
+    glo = ChainMap({'f': 'G', 'g': '{f}', 'h': '{g}/{p}', 'p': 'g'})
+    parent = Expander(glo)
+    one = Expander(ChainMap({'p': 'one'}, glo), parent)
+    two = Expander(ChainMap({'p': 'two'}, glo), parent)
+    assert one['h'] == 'G/one'
+    assert two['h'] == 'G/two'
+    assert one['g'] == 'G'
+    assert 'g' in parent.cache
+    assert 'h' not in parent.cache
+    assert parent['h'] == 'G/g'
+    parent.cache['g'] = ('cached', [('g', glo['g']), ('f', glo['f'])])
+    assert two['g'] == 'cached'
+
+def test_expander_graph():
+    e = Expander({**EXPANSIONS, 'd': '{c:{w}}{x}', 'w': 3})
+    assert e.graph(['d']) == {
+        'd': ('c', 'w', 'x'),
+        'c': ('b',),
+        'w': (),
+        'b': ('a',),
+        'a': (),
+    }
+
+def test_expander_order():
+    e = Expander(EXPANSIONS)
+    assert e.order(['c']) == ['a', 'b', 'c']
+    assert e.order(['x']) == []
+
+def test_expander_order_cycle():
+    e = Expander({'a': '{b}', 'b': '{c}/{a}', 'c': 'C'})
+    with pytest.raises(ValueError, match='a → b → a'):
+        e.order(['a'])
+
+def test_expander_tracked_cycle():
+    e = Expander({'a': '{b}', 'b': '{a}'})
+    with pytest.raises(ValueError, match=r'references: a → b → a$'):
+        Template.compile('x{a}').render_each([e], Expander({}))
+
+def test_expander_evaluate():
+    e = Expander({**EXPANSIONS, 'x': '{missing}'})
+    assert e.evaluate(['c', 'x', 'y']) == {'c': 'A-A=A-A'}
+    assert set(e.cache) == {'b', 'c'}
+
+def test_expander_cycle():
+    e = Expander(ChainMap({'name': 'n'}, {'dst': '{dst}/{name}'}))
+    with pytest.raises(ValueError, match='dst → dst'):
+        e.get('dst')
@@ -13,17 +13,19 @@ import testutil
 
 XDG_CONFIG_HOME = '/home/test/.config'
 XDG_DATA_HOME = '/home/test/.local/share'
-XDG_STATE_HOME = '/home/test/.local/state'
 XDG_CACHE_HOME = '/home/test/.cache'
 
 @pytest.fixture(name='setup')
-def _setup(monkeypatch):
+def _setup(monkeypatch, tmp_path):
+    # Operations write the state database, so keep it out of the real home.
+    state_home = str(tmp_path / 'state')
     monkeypatch.setenv('XDG_CONFIG_HOME', XDG_CONFIG_HOME)
     monkeypatch.setenv('XDG_DATA_HOME', XDG_DATA_HOME)
-    monkeypatch.setenv('XDG_STATE_HOME', XDG_STATE_HOME)
+    monkeypatch.setenv('XDG_STATE_HOME', state_home)
     monkeypatch.setenv('XDG_CACHE_HOME', XDG_CACHE_HOME)
     monkeypatch.setattr(Path, 'is_dir', lambda _: True)
     monkeypatch.setattr(Path, 'cwd', lambda: Path('/cwd'))
+    return state_home
 
 def test_read_inputs_env(setup):
     packages, gcm, config = gepare.read_inputs([io.BytesIO()])
@@ -103,6 +105,35 @@ def test_read_inputs_package_unknown_vcs(setup, capsys):
     err = capsys.readouterr().err
     assert 'wtf' in err
 
+@pytest.mark.parametrize('setting,message', [
+    ('depth = 0', 'depth must be a positive integer'),
+    ('sparse = 1', 'sparse must be'),
+    ('filter = true', 'filter must be a string'),
+])
+def test_read_inputs_package_invalid_option(setup, capsys, setting, message):
+    toml = bytes(
+        f"[package.one]\nsrc = 'http://example.com/one.git'\n{setting}\n"
+        "[package.two]\nsrc = 'http://example.com/two.git'\n",
+        encoding='ascii')
+    packages, _, _ = gepare.read_inputs([io.BytesIO(toml)])
+    assert list(packages) == ['two']
+    assert f'one: {message}' in capsys.readouterr().err
+
+def test_read_inputs_package_cycle(setup, capsys):
+    toml = b"""
+        [global]
+        dst = '{dst}/x'
+        [package.one]
+        src = 'http://example.com/one.git'
+        [package.two]
+        src = 'http://example.com/two.git'
+        dst = '/two'
+    """
+    packages, _, _ = gepare.read_inputs([io.BytesIO(toml)])
+    assert list(packages) == ['two']
+    err = capsys.readouterr().err
+    assert 'one: circular template references: dst → dst' in err
+
 def test_build_output(setup):
     key = 'gepare'
     src = f'https://codeberg.org/datatravelandexperiments/{key}'
@@ -131,7 +162,7 @@ def test_build_output(setup):
     assert out == {
         'CONFIG_HOME': XDG_CONFIG_HOME,
         'DATA_HOME': XDG_DATA_HOME,
-        'STATE_HOME': XDG_STATE_HOME,
+        'STATE_HOME': setup,
         'CACHE_HOME': XDG_CACHE_HOME,
         'gv': 1,
         'gz': '22',
@@ -1,10 +1,12 @@
 # SPDX-License-Identifier: MIT
 """Test git origin."""
 
+import asyncio
 import subprocess
 
 from pathlib import Path
 
+import pytest
 import testutil
 
 import gepare
@@ -56,4 +58,641 @@ def test_status(monkeypatch):
 
     g = gepare.GitOrigin('test', remote, Path(local))
     assert g.status() == gepare.OriginStatus.UNKNOWN
+    assert runs[0].args == ['git', 'status', '--porcelain=2', '--branch']
+
+def test_aclone(monkeypatch):
+    local = 'local'
+    remote = 'remote'
+    fake_run, runs = testutil.make_arun()
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', remote, Path(local))
+    assert asyncio.run(g.arefresh())
+    assert runs[0] == ['git', 'clone', remote, local]
+
+def test_aupdate(monkeypatch):
+    local = 'local'
+    remote = 'remote'
+    fake_run, runs = testutil.make_arun()
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', remote, Path(local))
+    assert asyncio.run(g.aupdate())
+    assert runs[0] == ['git', 'pull', '--rebase']
+
+def test_astatus(monkeypatch):
+    local = 'local'
+    remote = 'remote'
+    fake_run, runs = testutil.make_arun()
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', remote, Path(local))
+    assert asyncio.run(g.astatus()) == gepare.OriginStatus.UNKNOWN
+    assert runs[0] == ['git', 'status', '--porcelain=2', '--branch']
+
+SHA1 = '1111111111111111111111111111111111111111'
+SHA2 = '2222222222222222222222222222222222222222'
+STATUS = (0, f'# branch.oid {SHA1}\n'
+          '# branch.head main\n'
+          '# branch.upstream origin/main\n')
+
+def status_with(monkeypatch, results: dict) -> tuple:
+    fake_run, runs = testutil.make_run(results)
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    return g.status(), runs
+
+def test_status_dirty(monkeypatch):
+    status, _ = status_with(
+        monkeypatch, {'git status': (0, STATUS[1] + '? new-file\n')})
+    assert status == gepare.OriginStatus.DIRTY
+
+def test_status_unchanged(monkeypatch):
+    status, runs = status_with(monkeypatch, {
+        'git status': STATUS,
+        'git ls-remote': (0, f'{SHA1}\trefs/heads/main\n'),
+    })
+    assert status == gepare.OriginStatus.UNCHANGED
+    assert runs[1].args == ['git', 'ls-remote', '--heads', 'remote']
+    assert len(runs) == 2
+
+def test_status_ahead(monkeypatch):
+    status, runs = status_with(monkeypatch, {
+        'git status': STATUS,
+        'git ls-remote': (0, f'{SHA2}\trefs/heads/main\n'),
+        'git merge-base': (0, ''),
+    })
+    assert status == gepare.OriginStatus.UNCHANGED
+    assert runs[2].args == [
+        'git', 'merge-base', '--is-ancestor', SHA2, SHA1
+    ]
+
+def test_status_upgradable(monkeypatch):
+    status, _ = status_with(monkeypatch, {
+        'git status': STATUS,
+        'git ls-remote': (0, f'{SHA2}\trefs/heads/main\n'),
+        'git merge-base': (128, ''),
+    })
+    assert status == gepare.OriginStatus.UPGRADABLE
+
+def test_status_probe_failed(monkeypatch):
+    status, _ = status_with(monkeypatch, {
+        'git status': STATUS,
+        'git ls-remote': (128, ''),
+    })
+    assert status == gepare.OriginStatus.UNKNOWN
+
+def test_probe_shared(monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'git ls-remote': (0, f'{SHA1}\trefs/heads/main\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    refs = gepare.RemoteRefs()
+    for name in ('one', 'two'):
+        g = gepare.GitOrigin(name, 'https://Example.com/r.git/', Path(name))
+        g.refs = refs
+        assert g.probe()
+    assert len(runs) == 1
+    assert refs.get('git:https://example.com/r.git') == {
+        'refs/heads/main': SHA1
+    }
+
+def mirror_origin(name: str = 'test') -> gepare.GitOrigin:
+    options = gepare.Expander({'CACHE_HOME': '/cache', 'mirror': True})
+    return gepare.GitOrigin(name, 'https://example.com/r.git', Path(name),
+                            options)
+
+def test_mirror_path():
+    mirror = mirror_origin().mirror
+    assert mirror is not None
+    assert mirror.parent == Path('/cache/gepare/mirror')
+    assert mirror.name.startswith('r-')
+    assert mirror == mirror_origin('other').mirror
+    assert gepare.GitOrigin('test', 'remote', Path('local')).mirror is None
+
+def test_mirror_clone(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'test')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = mirror_origin()
+    assert g.refresh()
+    assert [r.args for r in runs] == [
+        [
+            'git', 'clone', '--reference',
+            str(g.mirror), '--dissociate',
+            str(g.mirror), 'test'
+        ],
+        ['git', 'remote', 'set-url', 'origin', 'https://example.com/r.git'],
+    ]
+
+def test_mirror_clone_branch(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'test')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = mirror_origin()
+    g.options = gepare.Expander({
+        'CACHE_HOME': '/cache',
+        'mirror': True,
+        'branch': 'dev',
+        'single_branch': True,
+    })
+    assert g.refresh()
+    assert runs[0].args == [
+        'git', 'clone', '--reference',
+        str(g.mirror), '--dissociate', '--branch', 'dev', '--single-branch',
+        str(g.mirror), 'test'
+    ]
+
+@pytest.mark.parametrize('options,shareable', [
+    ({}, True),
+    ({'depth': 1}, False),
+    ({'filter': 'blob:none'}, False),
+    ({'single_branch': True}, False),
+    ({'single_branch': False}, True),
+    ({'branch': 'dev'}, True),
+])
+def test_shareable(options, shareable):
+    g = gepare.GitOrigin('test', 'remote', Path('local'),
+                         gepare.Expander(options))
+    assert g.shareable == shareable
+
+def test_mirror_update(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = mirror_origin()
+    assert g.update_mirror()
+    assert g.refresh()
+    assert [r.args for r in runs] == [
+        ['git', 'fetch', '--prune', 'origin'],
+        [
+            'git', 'fetch', '--prune',
+            str(g.mirror), '+refs/heads/*:refs/remotes/origin/*'
+        ],
+        ['git', 'rebase'],
+    ]
+
+def test_mirror_create(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'mkdir', lambda *_a, **_k: None)
+
+    g = mirror_origin()
+    assert g.update_mirror()
+    assert runs[0].args == [
+        'git', 'clone', '--mirror', 'https://example.com/r.git',
+        str(g.mirror)
+    ]
+
+BRANCHES = {
+    'git symbolic-ref': (0, 'main\n'),
+    'git rev-parse': (0, 'origin/main\n'),
+}
+
+def test_peer_clone(monkeypatch):
+    fake_run, runs = testutil.make_run(BRANCHES)
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    g.peer = gepare.GitOrigin('peer', 'remote', Path('peer'))
+    assert g.clone()
+    assert [r.args for r in runs] == [
+        ['git', 'clone', '--no-checkout', 'peer', 'local'],
+        ['git', 'remote', 'set-url', 'origin', 'remote'],
+        [
+            'git', 'fetch', '--prune', 'peer',
+            '+refs/remotes/origin/*:refs/remotes/origin/*'
+        ],
+        ['git', 'symbolic-ref', '--quiet', '--short', 'HEAD'],
+        ['git', 'rev-parse', '--abbrev-ref', '@{upstream}'],
+        ['git', 'checkout', '--track', '-B', 'main', 'origin/main'],
+    ]
+
+def test_peer_clone_branch(monkeypatch):
+    fake_run, runs = testutil.make_run(BRANCHES)
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'),
+                         gepare.Expander({'branch': 'dev'}))
+    g.peer = gepare.GitOrigin('peer', 'remote', Path('peer'))
+    assert g.clone()
+    assert [r.args for r in runs[-2 :]] == [
+        ['git', 'checkout', '--track', '-B', 'dev', 'origin/dev'],
+        ['git', 'branch', '-D', 'main'],
+    ]
+
+def test_peer_clone_shallow_peer(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name == 'shallow')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    g.peer = gepare.GitOrigin('peer', 'remote', Path('peer'))
+    assert g.clone()
+    assert runs[0].args == ['git', 'clone', 'remote', 'local']
+
+def test_peer_update(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'shallow')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    g.peer = gepare.GitOrigin('peer', 'remote', Path('peer'))
+    assert g.update()
+    assert [r.args for r in runs] == [
+        [
+            'git', 'fetch', '--prune', 'peer',
+            '+refs/remotes/origin/*:refs/remotes/origin/*'
+        ],
+        ['git', 'rebase'],
+    ]
+
+def test_peer_update_rejected(monkeypatch, capsys):
+
+    def fake_run(args: list[str], **_) -> subprocess.CompletedProcess:
+        runs.append(args)
+        return subprocess.CompletedProcess(
+            args, 0, '', 'warning: rejected refs/remotes/origin/main because'
+            ' shallow roots are not allowed to be updated\n')
+
+    runs: list[list[str]] = []
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'shallow')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    g.peer = gepare.GitOrigin('peer', 'remote', Path('peer'))
+    assert not g.update()
+    assert len(runs) == 1
+    assert 'could not update all branches from peer' in capsys.readouterr().err
+
+def filter_origin(local: str = 'local') -> gepare.GitOrigin:
+    options = gepare.Expander({'kind': 'blob', 'filter': '{kind}:none'})
+    return gepare.GitOrigin('test', 'remote', Path(local), options)
+
+def test_filter_bootstrap(capsys):
+    local = '/usr/local/src/test'
+    assert filter_origin(local).bootstrap()
+    assert capsys.readouterr().out == (
+        'mkdir -p "/usr/local/src"\n'
+        f'if test -d "{local}"\n'
+        f'then (cd "{local}" && git fetch --filter=blob:none && git rebase)\n'
+        f'else git clone --filter=blob:none "remote" "{local}"\n'
+        'fi\n')
+
+def test_filter_clone(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert filter_origin().clone()
+    assert runs[0].args == [
+        'git', 'clone', '--filter=blob:none', 'remote', 'local'
+    ]
+
+def test_filter_update(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert filter_origin().update()
+    assert [r.args for r in runs] == [
+        ['git', 'fetch', '--filter=blob:none'],
+        ['git', 'rebase'],
+    ]
+
+def shallow_origin(**kwargs) -> gepare.GitOrigin:
+    options = gepare.Expander({'depth': 1, **kwargs})
+    return gepare.GitOrigin('test', 'remote', Path('local'), options)
+
+def test_shallow_clone(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = shallow_origin(branch='main', single_branch=False)
+    assert g.clone()
+    assert runs[0].args == [
+        'git', 'clone', '--depth', '1', '--branch', 'main',
+        '--no-single-branch', 'remote', 'local'
+    ]
+
+def test_shallow_update(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert shallow_origin().update()
+    assert [r.args for r in runs] == [
+        ['git', 'fetch', '--depth', '1'],
+        ['git', 'reset', '--keep', '@{upstream}'],
+    ]
+
+def test_shallow_update_deepened(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'shallow')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert shallow_origin().update()
+    assert runs[0].args == ['git', 'pull', '--rebase']
+
+def test_shallow_bootstrap(capsys):
+    assert shallow_origin().bootstrap()
+    out = capsys.readouterr().out
+    assert ('then (cd "local" && git fetch --depth 1'
+            " && git reset --keep '@{upstream}')\n") in out
+    assert 'else git clone --depth 1 "remote" "local"\n' in out
+
+def test_shallow_invalid_depth():
+    with pytest.raises(ValueError, match='depth'):
+        _ = shallow_origin(depth="none").depth
+
+def test_deepen(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert shallow_origin().deepen()
+    assert runs[0].args == ['git', 'fetch', '--unshallow']
+
+def test_deepen_complete(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'shallow')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert shallow_origin().deepen()
+    assert not runs
+
+def sparse_origin(sparse: object) -> gepare.GitOrigin:
+    options = gepare.Expander({'sub': 'doc', 'sparse': sparse})
+    return gepare.GitOrigin('test', 'remote', Path('local'), options)
+
+def test_sparse_clone(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert sparse_origin(['src/', '{sub}']).clone()
+    assert [r.args for r in runs] == [
+        ['git', 'clone', '--sparse', 'remote', 'local'],
+        ['git', 'sparse-checkout', 'set', '--cone', 'src', 'doc'],
+    ]
+
+def test_sparse_update_unchanged(monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'git sparse-checkout': (0, 'src\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert sparse_origin('src').update()
+    assert [r.args for r in runs] == [
+        ['git', 'sparse-checkout', 'list'],
+        ['git', 'pull', '--rebase'],
+    ]
+
+def test_sparse_update_changed(monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'git sparse-checkout': (0, 'src\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    assert sparse_origin(['src', 'doc']).update()
+    assert [r.args for r in runs] == [
+        ['git', 'sparse-checkout', 'list'],
+        ['git', 'sparse-checkout', 'set', '--cone', 'src', 'doc'],
+        ['git', 'pull', '--rebase'],
+    ]
+
+def test_sparse_fetch_changed(monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'git sparse-checkout': (0, 'src\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = sparse_origin(['src', 'doc'])
+    # Fetching leaves the working tree alone, for `integrate()` to change.
+    assert g.fetch() == gepare.OriginStatus.UPGRADABLE
+    assert [r.args for r in runs] == [
+        ['git', 'fetch'],
+        ['git', 'sparse-checkout', 'list'],
+    ]
+    runs.clear()
+    assert g.integrate()
+    assert [r.args for r in runs] == [
+        ['git', 'sparse-checkout', 'list'],
+        ['git', 'sparse-checkout', 'set', '--cone', 'src', 'doc'],
+        ['git', 'rebase'],
+    ]
+
+def test_sparse_bootstrap(capsys):
+    assert sparse_origin(['src']).bootstrap()
+    out = capsys.readouterr().out
+    assert ('then (cd "local" && git sparse-checkout set --cone src'
+            ' && git pull --rebase)\n') in out
+    assert ('else git clone --sparse "remote" "local"'
+            ' && (cd "local" && git sparse-checkout set --cone src)\n') in out
+
+def test_sparse_invalid():
+    with pytest.raises(ValueError, match='sparse'):
+        sparse_origin([1]).check_options()
+
+def test_fetch_unchanged(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    assert g.fetch() == gepare.OriginStatus.UNCHANGED
+    assert [r.args for r in runs] == [
+        ['git', 'fetch'],
+        ['git', 'merge-base', '--is-ancestor', '@{upstream}', 'HEAD'],
+    ]
+
+def test_fetch_upgradable(monkeypatch):
+    fake_run, runs = testutil.make_run({'git merge-base': (1, '')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = shallow_origin()
+    assert g.fetch() == gepare.OriginStatus.UPGRADABLE
+    assert g.integrate()
+    assert runs[0].args == ['git', 'fetch', '--depth', '1']
+    assert runs[2].args == ['git', 'reset', '--keep', '@{upstream}']
+
+def test_fetch_error(monkeypatch):
+    fake_run, runs = testutil.make_run({'git fetch': (1, '')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    assert g.fetch() == gepare.OriginStatus.ERROR
+    assert len(runs) == 1
+
+def test_peer_afetch(monkeypatch):
+    fake_arun, runs = testutil.make_arun()
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_arun)
+    monkeypatch.setattr(Path, 'exists', lambda p: p.name != 'shallow')
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.GitOrigin('test', 'remote', Path('local'))
+    g.peer = gepare.GitOrigin('peer', 'remote', Path('peer'))
+    status = asyncio.run(g.afetch())
+    assert status == gepare.OriginStatus.UNCHANGED
+    assert runs[0] == [
+        'git', 'fetch', '--prune', 'peer', gepare.PEER_REFSPEC
+    ]
+    assert asyncio.run(g.aintegrate())
+    assert runs[-1] == ['git', 'rebase']
+
+OID = '0123456789abcdef0123456789abcdef01234567'
+OID2 = '89abcdef0123456789abcdef0123456789abcdef'
+
+def make_repo(path: Path, url: str = 'https://example.com/r.git') -> Path:
+    git = path / '.git'
+    git.joinpath('refs', 'heads').mkdir(parents=True)
+    git.joinpath('HEAD').write_text('ref: refs/heads/main\n')
+    git.joinpath('refs', 'heads', 'main').write_text(f'{OID}\n')
+    git.joinpath('packed-refs').write_text(
+        '# pack-refs with: peeled fully-peeled sorted\n'
+        f'{OID2} refs/remotes/origin/main\n')
+    git.joinpath('config').write_text(
+        '[core]\n'
+        '\tbare = false\n'
+        '[remote "origin"]\n'
+        f'\turl = {url}\n'
+        '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+        '[branch "main"]\n'
+        '\tremote = origin\n'
+        '\tmerge = refs/heads/main\n')
+    return path
+
+def test_git_reader(tmp_path):
+    reader = gepare.GitReader(make_repo(tmp_path))
+    assert reader.head_ref == 'refs/heads/main'
+    assert reader.head == OID
+    assert reader.upstream() == ('origin', 'refs/heads/main')
+    assert reader.tracking_ref() == 'refs/remotes/origin/main'
+    assert reader.resolve('refs/remotes/origin/main') == OID2
+    assert reader.resolve('refs/heads/missing') is None
+    assert reader.remote_url() == 'https://example.com/r.git'
+
+def test_git_reader_detached(tmp_path):
+    make_repo(tmp_path).joinpath('.git', 'HEAD').write_text(f'{OID2}\n')
+    reader = gepare.GitReader(tmp_path)
+    assert reader.head_ref is None
+    assert reader.head == OID2
+    assert reader.upstream() is None
+
+def test_git_reader_unsupported(tmp_path):
+    with pytest.raises(ValueError):
+        gepare.GitReader(tmp_path)
+    tmp_path.joinpath('.git').write_text('gitdir: /elsewhere\n')
+    with pytest.raises(ValueError):
+        gepare.GitReader(tmp_path)
+    tmp_path.joinpath('.git').unlink()
+    make_repo(tmp_path).joinpath('.git', 'config').write_text(
+        '[extensions]\n\trefStorage = reftable\n')
+    with pytest.raises(ValueError):
+        gepare.GitReader(tmp_path)
+
+def test_parse_git_config():
+    config = gepare.parse_git_config('# comment\n'
+                                     '[Core] bare = false ; comment\n'
+                                     '[remote "My \\"Remote\\""]\n'
+                                     '  url = " a b " c\n'
+                                     '  fetch = x\n'
+                                     '  fetch = y\n'
+                                     '  mirror\n')
+    assert config == {
+        'core.bare': ['false'],
+        'remote.My "Remote".url': [' a b  c'],
+        'remote.My "Remote".fetch': ['x', 'y'],
+        'remote.My "Remote".mirror': ['true'],
+    }
+    with pytest.raises(ValueError):
+        gepare.parse_git_config('[core]\n\tx = a\\\n')
+
+def test_check_upstream(tmp_path, capsys):
+    make_repo(tmp_path)
+    g = gepare.GitOrigin('test', 'https://EXAMPLE.com/r.git/', tmp_path)
+    assert g._check()
+    g = gepare.GitOrigin('test', 'https://example.com/s.git', tmp_path)
+    assert not g._check()
+    assert 'has upstream https://example.com/r.git' in capsys.readouterr().err
+
+def test_fetch_up_to_date(tmp_path, monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    make_repo(tmp_path).joinpath('.git', 'packed-refs').write_text(
+        f'{OID} refs/remotes/origin/main\n')
+
+    g = gepare.GitOrigin('test', 'https://example.com/r.git', tmp_path)
+    assert g.fetch() == gepare.OriginStatus.UNCHANGED
+    assert [r.args for r in runs] == [['git', 'fetch']]
+
+def test_status_native(tmp_path, monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'git ls-remote': (0, f'{OID}\trefs/heads/main\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    make_repo(tmp_path)
+
+    g = gepare.GitOrigin('test', 'https://example.com/r.git', tmp_path)
+    assert g.status() == gepare.OriginStatus.UNCHANGED
     assert runs[0].args == ['git', 'status', '--porcelain=2']
+    assert runs[1].args[1] == 'ls-remote'
+
+def test_status_stat_cache(tmp_path, monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'git ls-remote': (0, f'{OID}\trefs/heads/main\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    local = make_repo(tmp_path / 'local')
+    local.joinpath('.git', 'index').write_bytes(b'')
+    path = tmp_path / 'status.json'
+
+    def status(**kwargs) -> int:
+        g = gepare.GitOrigin('test', 'https://example.com/r.git', local)
+        g.stats = gepare.StatCache(path, **kwargs)
+        g.status()
+        g.stats.save()
+        return [r.args[1] for r in runs].count('status')
+
+    assert status() == 1
+    assert status() == 1
+    assert status(exact=True) == 2
+    local.joinpath('new').write_text('')
+    assert status() == 3
+    assert status() == 3
@@ -1,10 +1,15 @@
 # SPDX-License-Identifier: MIT
 """Test Mercurial origin."""
 
+import asyncio
+import io
+import struct
 import subprocess
 
 from pathlib import Path
 
+import pytest
+
 import testutil
 
 import gepare
@@ -46,14 +51,241 @@ def test_refresh(monkeypatch):
     assert g.update()
     assert runs[0].args == ['hg', 'pull', '-u']
 
+IDENTIFY = '[{"branch": "default", "dirty": "", "node": "0123456789abcdef"}]'
+
 def test_status(monkeypatch):
     local = 'local'
     remote = 'remote'
-    fake_run, runs = testutil.make_run()
+    fake_run, runs = testutil.make_run({
+        'hg identify': (0, IDENTIFY),
+        'hg incoming': (1, ''),
+    })
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', remote, Path(local))
+    assert g.status() == gepare.OriginStatus.UNCHANGED
+    assert runs[0].args == ['hg', 'identify', '--template', 'json']
+    assert runs[1].args[: 2] == ['hg', 'incoming']
+    assert runs[1].args[-1] == remote
+    assert runs[2].args[: 2] == ['hg', 'log']
+
+def test_status_dirty(monkeypatch):
+    fake_run, runs = testutil.make_run(
+        {'hg identify': (0, IDENTIFY.replace('""', '"+"'))})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    assert g.status() == gepare.OriginStatus.DIRTY
+    assert len(runs) == 1
+
+def test_status_incoming(monkeypatch):
+    fake_run, runs = testutil.make_run({
+        'hg identify': (0, IDENTIFY),
+        'hg incoming': (0, 'aaa default\nbbb stable\nccc default\n'),
+    })
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    refs = gepare.RemoteRefs()
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    g.refs = refs
+    assert g.status() == gepare.OriginStatus.UPGRADABLE
+    assert refs.get(g.probe_key) == {'default': 'ccc', 'stable': 'bbb'}
+    assert runs[-1].args[-1] == 'id(ccc)'
+
+def test_status_pulled(monkeypatch):
+    fake_run, _ = testutil.make_run({
+        'hg identify': (0, IDENTIFY),
+        'hg incoming': (1, ''),
+        'hg log': (0, 'ccc\n'),
+    })
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    assert g.status() == gepare.OriginStatus.UPGRADABLE
+
+def test_status_error(monkeypatch):
+    fake_run, _ = testutil.make_run({'hg identify': (255, '')})
     monkeypatch.setattr(subprocess, 'run', fake_run)
     monkeypatch.setattr(Path, 'exists', lambda _: True)
     monkeypatch.setattr(Path, 'is_dir', lambda _: True)
 
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    assert g.status() == gepare.OriginStatus.ERROR
+
+def test_aclone(monkeypatch):
+    local = 'local'
+    remote = 'remote'
+    fake_run, runs = testutil.make_arun()
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', remote, Path(local))
+    assert asyncio.run(g.arefresh())
+    assert runs[0] == ['hg', 'clone', remote, local]
+
+def test_aupdate(monkeypatch):
+    local = 'local'
+    remote = 'remote'
+    fake_run, runs = testutil.make_arun()
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', remote, Path(local))
+    assert asyncio.run(g.aupdate())
+    assert runs[0] == ['hg', 'pull', '-u']
+
+def test_astatus(monkeypatch):
+    local = 'local'
+    remote = 'remote'
+    fake_run, runs = testutil.make_arun({'hg identify': (0, IDENTIFY)})
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
     g = gepare.MercurialOrigin('test', remote, Path(local))
-    assert g.status() == gepare.OriginStatus.UNKNOWN
-    assert runs[0].args == ['hg', 'status']
+    assert asyncio.run(g.astatus()) == gepare.OriginStatus.UNCHANGED
+    assert runs[0] == ['hg', 'identify', '--template', 'json']
+
+def test_peer_clone(monkeypatch, tmp_path):
+    local = tmp_path / 'local'
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    # Stand in for the clone.
+    local.joinpath('.hg').mkdir(parents=True)
+    monkeypatch.setattr(gepare.Origin, 'check_local_is_available',
+                        lambda _: True)
+
+    g = gepare.MercurialOrigin('test', 'remote', local)
+    g.peer = gepare.MercurialOrigin('peer', 'remote', Path('peer'))
+    assert g.clone()
+    assert runs[0].args == ['hg', 'clone', 'peer', str(local)]
+    assert local.joinpath('.hg', 'hgrc').read_text() == (
+        '[paths]\ndefault = remote\n')
+
+def test_peer_update(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    g.peer = gepare.MercurialOrigin('peer', 'remote', Path('peer'))
+    assert g.update()
+    assert runs[0].args == ['hg', 'pull', '-u', 'peer']
+
+def test_fetch(monkeypatch):
+    fake_run, runs = testutil.make_run({'hg log': (0, 'abc123\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    assert g.fetch() == gepare.OriginStatus.UPGRADABLE
+    assert runs[0].args == ['hg', 'pull']
+    assert runs[1].args[: 2] == ['hg', 'log']
+    assert g.integrate()
+    assert runs[2].args == ['hg', 'update']
+
+def test_fetch_unchanged(monkeypatch):
+    fake_run, _ = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'))
+    assert g.fetch() == gepare.OriginStatus.UNCHANGED
+
+def frame(channel: bytes, data: bytes) -> bytes:
+    return channel + struct.pack('>I', len(data)) + data
+
+class FakeServer:
+    """Fake `hg serve --cmdserver pipe` process, with canned responses."""
+
+    instances: list['FakeServer'] = []
+
+    def __init__(self, args: list[str], **kwargs) -> None:
+        self.args = args
+        self.kwargs = kwargs
+        self.stdin = testutil.bytesio()
+        self.stdout = io.BytesIO(
+            frame(b'o', b'capabilities: getencoding runcommand\n'
+                  b'encoding: UTF-8\npid: 1') +
+            # Response to the first command.
+            frame(b'e', b'warning\n') + b'L' + struct.pack('>I', 4096) +
+            frame(b'o', b'pulled\n') + frame(b'r', struct.pack('>i', 1)) +
+            # Response to the second command.
+            frame(b'r', struct.pack('>i', 0)))
+        self.waited = False
+        self.instances.append(self)
+        kwargs['stderr'].write(b'server message\n')
+        kwargs['stderr'].flush()
+
+    def wait(self) -> int:
+        self.waited = True
+        return 0
+
+def test_cmdserver(monkeypatch):
+    FakeServer.instances.clear()
+    monkeypatch.setattr(subprocess, 'Popen', FakeServer)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+    out = testutil.stringio()
+
+    options = gepare.Expander({'cmdserver': True})
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'), options)
+    g.stdout = out
+    assert not g.update()
+    assert out.getvalue() == 'test:\nwarning\nserver message\n\npulled\n\n'
+    assert g.integrate()
+    g.close()
+    assert len(FakeServer.instances) == 1
+    server = FakeServer.instances[0]
+    assert server.args == ['hg', 'serve', '--cmdserver', 'pipe']
+    assert server.kwargs['cwd'] == Path('local')
+    assert server.stdin.getvalue() == (
+        b'runcommand\n' + struct.pack('>I', 7) + b'pull\0-u' +
+        struct.pack('>I', 0) + b'runcommand\n' + struct.pack('>I', 6) +
+        b'update')
+    assert server.waited
+
+def test_cmdserver_exited(monkeypatch):
+
+    class ExitedServer(FakeServer):
+
+        def __init__(self, args: list[str], **kwargs) -> None:
+            super().__init__(args, **kwargs)
+            self.stdout = io.BytesIO()
+            kwargs['stderr'].write(b'abort: no repository found\n')
+            kwargs['stderr'].flush()
+
+    monkeypatch.setattr(subprocess, 'Popen', ExitedServer)
+    with pytest.raises(EOFError, match='abort: no repository found'):
+        gepare.HgCommandServer(Path('local'))
+
+def test_cmdserver_unavailable(monkeypatch, capsys):
+
+    def fake_popen(*_a, **_k):
+        raise FileNotFoundError('hg')
+
+    monkeypatch.setattr(subprocess, 'Popen', fake_popen)
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    options = gepare.Expander({'cmdserver': True})
+    g = gepare.MercurialOrigin('test', 'remote', Path('local'), options)
+    assert g.update()
+    assert g.update()
+    assert [r.args for r in runs] == [['hg', 'pull', '-u']] * 2
+    assert capsys.readouterr().err.count('command server failed') == 1
@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: MIT
+"""Test host limits."""
+
+import pytest
+
+from gepare import Expander, HostLimits, same_source, source_host
+
+def test_source_host_url():
+    assert source_host('https://Example.com/a/b.git') == 'example.com'
+    assert source_host('ssh://git@example.com:2222/a/b.git') == 'example.com'
+
+def test_source_host_scp():
+    assert source_host('git@example.com:a/b.git') == 'example.com'
+    assert source_host('example.com:b.git') == 'example.com'
+    assert source_host('[::1]:b.git') == '::1'
+
+def test_source_host_local():
+    assert source_host('file:///usr/local/src/a.git') == ''
+    assert source_host('/usr/local/src/a.git') == ''
+    assert source_host('./a:b') == ''
+    assert source_host('a') == ''
+
+@pytest.mark.parametrize('a,b', [
+    ('https://github.com/x/y', 'https://github.com/x/y.git'),
+    ('https://GitHub.com/x/y/', 'https://github.com/x/y'),
+    ('git@github.com:x/y.git', 'https://github.com/x/y'),
+    ('ssh://git@github.com:22/x/y.git', 'git@github.com:x/y'),
+    ('git@[::1]:x/y', 'ssh://[::1]/x/y'),
+])
+def test_same_source(a, b):
+    assert same_source(a, b)
+
+@pytest.mark.parametrize('a,b', [
+    ('https://github.com/x/y', 'https://github.com/x/z'),
+    ('https://github.com/x/y', 'https://gitlab.com/x/y'),
+    ('https://github.com/x/y', '/x/y'),
+])
+def test_same_source_different(a, b):
+    assert not same_source(a, b)
+
+def test_host_limits_from_config():
+    config = {
+        'host': {
+            'Slow.example.com': {'max_per_host': 2},
+            'other.example.com': {},
+        },
+    }
+    limits = HostLimits.from_config(Expander({'max_per_host': '8'}), config)
+    assert limits.limit('slow.example.com') == 2
+    assert limits.limit('other.example.com') == 8
+    assert limits.limit('') is None
+
+def test_host_limits_default():
+    limits = HostLimits.from_config(Expander({}), {})
+    assert limits.limit('example.com') is None
+
+def test_host_limits_invalid():
+    with pytest.raises(ValueError, match='max_per_host'):
+        HostLimits.from_config(Expander({'max_per_host': 0}), {})
+    with pytest.raises(ValueError, match='host.a'):
+        HostLimits.from_config(
+            Expander({}), {'host': {'a': {'max_per_host': 'x'}}})
@@ -0,0 +1,436 @@
+# SPDX-License-Identifier: MIT
+"""Test parallel package operations."""
+
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+
+from pathlib import Path
+
+import pytest
+
+import gepare
+import testutil
+
+def make_package(name: str, remote: str = 'remote') -> gepare.Package:
+    origin = gepare.GitOrigin(name, remote, Path(name))
+    return gepare.Package(name, origin, gepare.Expander({}))
+
+def test_run_jobs_order(capsys):
+    packages = [make_package(name) for name in 'abcd']
+    # Finish in reverse order of submission.
+    events = {p.name: threading.Event() for p in packages}
+
+    def work(package: gepare.Package) -> bool:
+        names = [p.name for p in packages]
+        i = names.index(package.name)
+        if i + 1 < len(names):
+            assert events[names[i + 1]].wait(5)
+        package.origin.print(f'{package.name} out')
+        package.origin.error('err')
+        events[package.name].set()
+        return True
+
+    assert gepare.run_jobs(packages, work, 4)
+    oe = capsys.readouterr()
+    assert oe.out == 'a out\nb out\nc out\nd out\n'
+    assert oe.err == ''.join(f'gepare: {n}: err\n' for n in 'abcd')
+    assert all(p.origin.stdout is None for p in packages)
+
+def test_run_jobs_failure():
+    packages = [make_package(name) for name in 'abc']
+    assert not gepare.run_jobs(packages, lambda p: p.name != 'b', 2)
+
+def test_run_jobs_exception(capsys):
+    packages = [make_package(name) for name in 'ab']
+
+    def work(package: gepare.Package) -> bool:
+        package.origin.print(package.name)
+        if package.name == 'b':
+            raise ValueError(package.name)
+        return True
+
+    with pytest.raises(ValueError, match='b'):
+        gepare.run_jobs(packages, work, 2)
+    assert capsys.readouterr().out == 'a\nb\n'
+
+def test_run_jobs_host_limit(capsys):
+    packages = [
+        make_package(f'{host}{i}', f'https://{host}.example.com/{i}.git')
+        for host in 'ab'
+        for i in range(4)
+    ]
+    lock = threading.Lock()
+    active = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+
+    def work(package: gepare.Package) -> bool:
+        host = package.name[0]
+        with lock:
+            active[host] += 1
+            peak[host] = max(peak[host], active[host])
+        time.sleep(0.01)
+        with lock:
+            active[host] -= 1
+        package.origin.print(package.name)
+        return True
+
+    limits = gepare.HostLimits(hosts={'a.example.com': 1})
+    assert gepare.run_jobs(packages, work, 4, limits)
+    assert peak['a'] == 1
+    assert peak['b'] > 1
+    assert capsys.readouterr().out.split() == [p.name for p in packages]
+
+def test_run_jobs_after(capsys):
+    packages = [make_package(name) for name in 'abc']
+    started = []
+
+    def work(package: gepare.Package) -> bool:
+        started.append(package.name)
+        package.origin.print(package.name)
+        return True
+
+    # `a` runs after `c`, which runs after `b`.
+    deps = {'a': [packages[2]], 'c': [packages[1]]}
+    assert gepare.run_jobs(packages, work, 3, None,
+                           lambda p: deps.get(p.name, []))
+    assert started == ['b', 'c', 'a']
+    assert capsys.readouterr().out == 'a\nb\nc\n'
+
+def test_deduplicate():
+    packages = [
+        make_package('a', 'https://example.com/r.git'),
+        make_package('b', 'https://example.com/s.git'),
+        make_package('c', 'https://EXAMPLE.com/r.git/'),
+    ]
+    gepare.deduplicate(packages)
+    assert packages[0].peer is None
+    assert packages[1].peer is None
+    assert packages[2].peer is packages[0]
+    assert packages[2].origin.peer is packages[0].origin
+
+TOML = b"""
+    [package.a]
+    src = 'https://example.com/a.git'
+    dst = '/usr/local/src/a'
+
+    [package.b]
+    src = 'https://example.com/b.git'
+    dst = '/usr/local/src/b'
+"""
+
+@pytest.fixture(name='setup')
+def _setup(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmp_path / 'data'))
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path / 'state'))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(TOML))
+    # Leave paths unprobed, so that origins use the fake `Path` methods.
+    monkeypatch.setattr(gepare.FileTypes, 'probe', lambda *_: None)
+
+def test_main_status(setup, monkeypatch, capsys):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-s', '-J', '2', 'test.toml'])
+    assert r == 0
+    assert sorted(run.args[1] for run in runs) == [
+        'ls-remote', 'ls-remote', 'status', 'status'
+    ]
+    out, err = capsys.readouterr()
+    assert out == 'a: unknown\nb: unknown\n'
+    assert err == 'remote ref cache: 0 hit(s), 2 miss(es)\n'
+
+def test_main_status_json(setup, monkeypatch, capsys):
+    fake_run, _ = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-s', '-j', '-J', '2', 'test.toml'])
+    assert r == 0
+    out, err = capsys.readouterr()
+    assert sorted(json.loads(out)['package']) == ['a', 'b']
+    assert err == ('a: unknown\nb: unknown\n'
+                   'remote ref cache: 0 hit(s), 2 miss(es)\n')
+
+def test_main_bad_limit(setup, monkeypatch, capsys):
+    toml = b'[global]\nmax_per_host = 0\n' + TOML
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(toml))
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    # Without repository operations, the limit does not matter.
+    assert gepare.main(['gepare', '-j', 'test.toml']) == 0
+    capsys.readouterr()
+    assert gepare.main(['gepare', '-r', 'test.toml']) == 1
+    assert 'global: max_per_host must be at least 1' in capsys.readouterr().err
+    assert runs == []
+
+def test_main_bad_ttl(setup, monkeypatch, capsys):
+    toml = b"[global]\nref_cache_ttl = 'x'\n" + TOML
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(toml))
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    # Without probing, the TTL does not matter.
+    assert gepare.main(['gepare', '-r', '-j', 'test.toml']) == 0
+    capsys.readouterr()
+    runs.clear()
+    assert gepare.main(['gepare', '-s', 'test.toml']) == 1
+    assert 'ref_cache_ttl: invalid duration ‘x’' in capsys.readouterr().err
+    assert runs == []
+
+def test_main_refresh_failure(setup, monkeypatch):
+
+    def fake_run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.CompletedProcess(args, 1, '', '')
+
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-r', 'test.toml'])
+    assert r == 1
+
+def test_main_only_upgradable(setup, monkeypatch):
+    sha = '0123456789abcdef0123456789abcdef01234567'
+    fake_run, runs = testutil.make_run({
+        'git status': (0, f'# branch.oid {sha}\n'
+                       '# branch.head main\n'
+                       '# branch.upstream origin/main\n'),
+        'git ls-remote': (0, f'{sha}\trefs/heads/main\n'),
+    })
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-r', '--only-upgradable', 'test.toml'])
+    assert r == 0
+    assert [run.args[1] for run in runs if run.args[1] != 'ls-remote'] == [
+        'status', 'status'
+    ]
+
+def test_main_status_cached(setup, monkeypatch, capsys):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    assert gepare.main(['gepare', '-s', 'test.toml']) == 0
+    assert gepare.main(['gepare', '-s', 'test.toml']) == 0
+    assert [run.args[1] for run in runs].count('ls-remote') == 2
+    assert capsys.readouterr().err.endswith('0 miss(es)\n')
+    assert gepare.main(['gepare', '-s', '--refresh-cache', 'test.toml']) == 0
+    assert [run.args[1] for run in runs].count('ls-remote') == 4
+    assert gepare.main(['gepare', '-s', '--no-cache', 'test.toml']) == 0
+    assert [run.args[1] for run in runs].count('ls-remote') == 6
+    assert 'cache' not in capsys.readouterr().out.splitlines()[-1]
+
+def test_update_mirrors(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    options = gepare.Expander({'CACHE_HOME': '/cache', 'mirror': 'yes'})
+    packages = [
+        gepare.Package(
+            name,
+            gepare.GitOrigin(name, 'https://example.com/r.git', Path(name),
+                             options), options) for name in 'abc'
+    ]
+    assert gepare.update_mirrors(packages, 2)
+    assert len(runs) == 1
+
+def test_main_deduplicate(setup, monkeypatch, capsys):
+    toml = TOML.replace(b'/b.git', b'/a.git')
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(toml))
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    fake_run, runs = testutil.make_run({'git rev-parse': (0, 'origin/main')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-r', '-j', 'test.toml'])
+    assert r == 0
+    assert runs[0].args == [
+        'git', 'clone', 'https://example.com/a.git', '/usr/local/src/a'
+    ]
+    assert runs[1].args == [
+        'git', 'clone', '--no-checkout', '/usr/local/src/a', '/usr/local/src/b'
+    ]
+    assert runs[-1].args == [
+        'git', 'checkout', '--track', '-B', 'main', 'origin/main'
+    ]
+    j = json.loads(capsys.readouterr().out)
+    assert 'fetched_from' not in j['package']['a']
+    assert j['package']['b']['fetched_from'] == 'a'
+
+def test_main_deduplicate_fallback(setup, monkeypatch):
+    toml = TOML.replace(b'/b.git', b'/a.git')
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(toml))
+    monkeypatch.setattr(Path, 'exists', lambda _: False)
+    fake_run, runs = testutil.make_run({'git clone': (1, '')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-r', 'test.toml'])
+    assert r == 1
+    assert runs[1].args == [
+        'git', 'clone', 'https://example.com/a.git', '/usr/local/src/b'
+    ]
+
+def test_main_jobs_invalid(setup):
+    with pytest.raises(SystemExit):
+        gepare.main(['gepare', '-r', '-J', '0', 'test.toml'])
+
+def test_main_refresh_two_stages(setup, monkeypatch):
+    # Only `b` has fetched anything to integrate.
+    def fake_run(args: list[str], **kwargs) -> subprocess.CompletedProcess:
+        runs.append(args)
+        upgradable = args[1] == 'merge-base' and 'src/b' in str(kwargs['cwd'])
+        return subprocess.CompletedProcess(args, int(upgradable), '', '')
+
+    runs: list[list[str]] = []
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    r = gepare.main(['gepare', '-r', '--local-jobs', '1', 'test.toml'])
+    assert r == 0
+    # Integration waits for all fetches.
+    assert sorted(args[1] for args in runs[: 4]) == [
+        'fetch', 'fetch', 'merge-base', 'merge-base'
+    ]
+    assert runs[4 :] == [['git', 'rebase']]
+
+def test_main_local_jobs_invalid(setup):
+    with pytest.raises(SystemExit):
+        gepare.main(['gepare', '-r', '--local-jobs', '0', 'test.toml'])
+
+def test_file_types(tmp_path):
+    for name in 'ab':
+        tmp_path.joinpath(name, '.git').mkdir(parents=True)
+    tmp_path.joinpath('f').write_text('')
+    tmp_path.joinpath('l').symlink_to('a')
+    paths = [tmp_path / name for name in ['a', 'b', 'f', 'l', 'missing']]
+    files = gepare.FileTypes()
+    files.probe([*paths, tmp_path / 'a' / '.git', tmp_path / 'none' / 'x'])
+    assert files.types == {
+        tmp_path / 'a': 'dir',
+        tmp_path / 'b': 'dir',
+        tmp_path / 'f': 'file',
+        tmp_path / 'l': 'symlink',
+        tmp_path / 'missing': None,
+        tmp_path / 'a' / '.git': 'dir',
+        tmp_path / 'none' / 'x': None,
+    }
+    assert [files.exists(p) for p in paths] == [True, True, True, True, False]
+    assert [files.is_dir(p) for p in paths] == [True, True, False, True, False]
+    assert [files.is_symlink(p) for p in paths] == [
+        False, False, False, True, False
+    ]
+    tmp_path.joinpath('missing').mkdir()
+    assert not files.exists(tmp_path / 'missing')
+    files.forget(tmp_path)
+    assert files.types == {}
+    assert files.exists(tmp_path / 'missing')
+
+def test_main_file_types(monkeypatch, tmp_path):
+    for name in ['CONFIG', 'DATA', 'STATE', 'CACHE']:
+        monkeypatch.setenv(f'XDG_{name}_HOME', str(tmp_path / name.lower()))
+    toml = TOML.replace(b'/usr/local/src', str(tmp_path).encode())
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(toml))
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda p: scans.append(p) or scandir(p))
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    assert gepare.main(['gepare', '-r', 'test.toml']) == 0
+    assert scans == [tmp_path]
+    assert [r.args[1] for r in runs] == ['clone', 'clone']
+
+def test_run_jobs_priority(capsys):
+    packages = [make_package(name) for name in 'abcd']
+    started = []
+
+    def work(package: gepare.Package) -> bool:
+        started.append(package.name)
+        package.origin.print(package.name)
+        return True
+
+    costs = {'a': 1.0, 'b': 5.0, 'c': 1.0, 'd': 3.0}
+    assert gepare.run_jobs(packages, work, 1, priority=lambda p: costs[p.name])
+    assert started == ['b', 'd', 'a', 'c']
+    assert capsys.readouterr().out == 'a\nb\nc\nd\n'
+
+def test_predict_makespan():
+    assert gepare.predict_makespan([], 2) == 0
+    assert gepare.predict_makespan([3, 3, 2, 2, 2], 2) == 7
+    assert gepare.predict_makespan([1, 5, 1, 3], 2) == 5
+    assert gepare.predict_makespan([1, 5, 1, 3], 1) == 10
+
+def test_main_schedule(setup, monkeypatch, capsys):
+    fake_run, _ = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    assert gepare.main(['gepare', '-r', '-j', 'test.toml']) == 0
+    schedule = json.loads(capsys.readouterr().out)['schedule']
+    assert schedule['predicted'] is None
+    assert schedule['actual'] >= 0
+    assert gepare.main(['gepare', '-r', '-j', 'test.toml']) == 0
+    schedule = json.loads(capsys.readouterr().out)['schedule']
+    assert schedule['predicted'] >= 0
+
+def make_packages(info: dict[str, dict]) -> dict[str, gepare.Package]:
+    packages = {}
+    for name, properties in info.items():
+        dst = Path(properties.pop('dst', f'/src/{name}'))
+        origin = gepare.GitOrigin(name, f'https://example.com/{name}.git', dst)
+        packages[name] = gepare.Package(name, origin,
+                                        gepare.Expander(properties))
+    return packages
+
+def test_link_after(capsys):
+    packages = make_packages({
+        'a': {'after': 'c'},
+        'b': {'dst': '/src/a/sub/b', 'after': ['missing']},
+        'c': {},
+    })
+    gepare.link_after(packages)
+    a, b, c = packages.values()
+    assert a.after == [c]
+    assert b.after == [a]
+    assert c.after == []
+    assert 'unknown package missing' in capsys.readouterr().err
+    assert gepare.find_cycle(packages.values()) is None
+
+def test_find_cycle():
+    packages = make_packages({
+        'a': {},
+        'b': {'after': 'd'},
+        'c': {'after': 'b'},
+        'd': {'after': ['a', 'c']},
+    })
+    gepare.link_after(packages)
+    a, b, c, d = packages.values()
+    assert gepare.find_cycle(packages.values()) == [b, d, c, b]
+    # Dependencies outside the set are ignored.
+    assert gepare.find_cycle([a, b, d]) is None
+
+def test_deduplicate_after():
+    packages = make_packages({'a': {'after': 'b'}, 'b': {}})
+    for package in packages.values():
+        package.origin.remote = 'https://example.com/r.git'
+    gepare.link_after(packages)
+    gepare.deduplicate(packages.values())
+    # `a` must wait for `b`, so `b` cannot fetch from `a`.
+    assert packages['b'].peer is None
+    assert gepare.find_cycle(packages.values()) is None
+
+def test_run_jobs_nested(capsys):
+    packages = make_packages({'a': {'dst': '/src/b/a'}, 'b': {}, 'c': {}})
+    gepare.link_after(packages)
+    started = []
+
+    def work(package: gepare.Package) -> bool:
+        started.append(package.name)
+        return True
+
+    assert gepare.run_jobs(packages.values(), work, 1, None,
+                           gepare.Package.predecessors)
+    assert started == ['b', 'a', 'c']
+
+def test_main_cycle(setup, monkeypatch, capsys):
+    toml = TOML.replace(b"dst = '/usr/local/src/a'",
+                        b"dst = '/usr/local/src/a'\nafter = 'b'")
+    toml = toml.replace(b"dst = '/usr/local/src/b'",
+                        b"dst = '/usr/local/src/b'\nafter = 'a'")
+    monkeypatch.setattr(Path, 'open', lambda *_a, **_k: io.BytesIO(toml))
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    assert gepare.main(['gepare', '-r', 'test.toml']) == 1
+    assert runs == []
+    assert 'circular package dependencies: a → b → a' in (
+        capsys.readouterr().err)
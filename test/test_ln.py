@@ -0,0 +1,39 @@
+# SPDX-License-Identifier: MIT
+"""Test symbolic link origin."""
+
+import asyncio
+
+import gepare
+
+def test_clone(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    local = tmp_path / 'dir' / 'local'
+
+    g = gepare.SymlinkOrigin('test', str(src), local)
+    assert g.refresh()
+    assert local.is_symlink()
+    assert local.resolve() == src.resolve()
+    assert g.status() == gepare.OriginStatus.UNCHANGED
+
+def test_aclone(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    local = tmp_path / 'local'
+
+    g = gepare.SymlinkOrigin('test', str(src), local)
+    assert asyncio.run(g.arefresh())
+    assert asyncio.run(g.arefresh())
+    assert asyncio.run(g.astatus()) == gepare.OriginStatus.UNCHANGED
+
+def test_status_wrong_target(tmp_path, capsys):
+    src = tmp_path / 'src'
+    src.mkdir()
+    other = tmp_path / 'other'
+    other.mkdir()
+    local = tmp_path / 'local'
+    local.symlink_to(other)
+
+    g = gepare.SymlinkOrigin('test', str(src), local)
+    assert g.status() == gepare.OriginStatus.ERROR
+    assert 'does not point to' in capsys.readouterr().err
@@ -0,0 +1,244 @@
+# SPDX-License-Identifier: MIT
+"""Test persistent state."""
+
+import sqlite3
+import subprocess
+import time
+
+from pathlib import Path
+
+import testutil
+
+import gepare
+
+from gepare import StateStore
+
+def test_state_store(tmp_path):
+    path = tmp_path / 'state' / 'state.db'
+    state = StateStore(path)
+    state.record('a', 'fetch', 100.0, 2.5, 0, 'x', 'y', 10)
+    state.record('a', 'fetch', 200.0, 1.5, 1, 'y', 'y', 20)
+    state.record('a', 'status', 300.0, 0.5, 0, 'y', 'y', 0)
+    state.close()
+
+    state = StateStore(path)
+    history = state.history('a', 'fetch')
+    assert [h['started'] for h in history] == [200.0, 100.0]
+    assert history[1] == {
+        'package': 'a',
+        'operation': 'fetch',
+        'started': 100.0,
+        'duration': 2.5,
+        'status': 0,
+        'head_before': 'x',
+        'head_after': 'y',
+        'output_bytes': 10,
+    }
+    assert state.history('b', 'fetch') == []
+    state.close()
+
+def test_state_store_shared(tmp_path):
+    path = tmp_path / 'state.db'
+    state = StateStore(path)
+    other = StateStore(path)
+    state.record('a', 'fetch', 100.0, 2.5, 0, 'x', 'y', 10)
+    assert other.last_refresh('a') == 100.0
+    state.close()
+    other.close()
+
+def test_state_store_locked(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(StateStore, 'TIMEOUT', 0.1)
+    path = tmp_path / 'state.db'
+    state = StateStore(path)
+    lock = sqlite3.connect(path)
+    lock.execute('BEGIN IMMEDIATE')
+    state.record('a', 'fetch', 100.0, 2.5, 0, 'x', 'y', 10)
+    assert 'could not record fetch of a: database is locked' in (
+        capsys.readouterr().err)
+    lock.rollback()
+    state.record('a', 'fetch', 200.0, 2.5, 0, 'x', 'y', 10)
+    assert [h['started'] for h in state.history('a', 'fetch')] == [200.0]
+    lock.close()
+    state.close()
+
+def test_state_store_keep(monkeypatch):
+    monkeypatch.setattr(StateStore, 'KEEP', 3)
+    state = StateStore()
+    for started in range(5):
+        state.record('a', 'status', started, 1.0, 0, None, None, 0)
+    state.record('b', 'status', 0, 1.0, 0, None, None, 0)
+    assert [h['started'] for h in state.history('a', 'status')] == [4, 3, 2]
+    assert len(state.history('b', 'status')) == 1
+
+def test_operations_record(monkeypatch):
+    fake_run, _ = testutil.make_run({'git fetch': (1, 'failed\n')})
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    origin = gepare.GitOrigin('a', 'remote', Path('a'))
+    package = gepare.Package('a', origin, gepare.Expander({}))
+    state = StateStore()
+    operations = gepare.Operations(refresh=True, state=state)
+    assert not operations.run([package])
+    [fetch] = state.history('a', 'fetch')
+    assert fetch['status'] == 1
+    assert fetch['output_bytes'] == len('a:\nfailed\n\n')
+    assert fetch['head_before'] is None
+    assert state.history('a', 'integrate') == []
+
+def test_hg_head(tmp_path):
+    origin = gepare.MercurialOrigin('a', 'remote', tmp_path)
+    assert origin.head() is None
+    tmp_path.joinpath('.hg').mkdir()
+    tmp_path.joinpath('.hg', 'dirstate').write_bytes(bytes(range(40)))
+    assert origin.head() == bytes(range(20)).hex()
+
+def test_last_refresh():
+    state = StateStore()
+    assert state.last_refresh('a') is None
+    state.record('a', 'clone', 100.0, 1.0, 0, None, 'x', 0)
+    state.record('a', 'status', 150.0, 1.0, 0, 'x', 'x', 0)
+    assert state.last_refresh('a') == 100.0
+    state.record('a', 'fetch', 200.0, 1.0, 1, 'x', 'x', 0)
+    assert state.last_refresh('a') == 100.0
+    state.record('a', 'fetch', 300.0, 1.0, 0, 'x', 'x', 0)
+    state.record('a', 'integrate', 301.0, 1.0, 1, 'x', 'x', 0)
+    assert state.last_refresh('a') is None
+    state.record('a', 'fetch', 400.0, 1.0, 0, 'x', 'x', 0)
+    assert state.last_refresh('a') == 400.0
+
+def make_packages(**info) -> list[gepare.Package]:
+    return [
+        gepare.Package(name, gepare.GitOrigin(name, 'remote', Path(name)),
+                       gepare.Expander(info)) for name in 'ab'
+    ]
+
+def test_max_age(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    state = StateStore()
+    state.record('a', 'fetch', time.time() - 60, 1.0, 0, None, None, 0)
+    state.record('b', 'fetch', time.time() - 7200, 1.0, 0, None, None, 0)
+    operations = gepare.Operations(refresh=True, state=state, max_age=3600)
+    assert operations.run(make_packages())
+    assert [r.args[1] for r in runs].count('fetch') == 1
+    assert len(state.history('a', 'fetch')) == 1
+    assert len(state.history('b', 'fetch')) == 2
+
+def test_refresh_interval(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    state = StateStore()
+    for name in 'ab':
+        state.record(name, 'fetch', time.time() - 60, 1.0, 0, None, None, 0)
+    packages = make_packages(refresh_interval='1h')
+    packages[1].info = gepare.Expander({'refresh_interval': 30})
+    operations = gepare.Operations(refresh=True, state=state)
+    assert operations.run(packages)
+    assert len(state.history('a', 'fetch')) == 1
+    assert len(state.history('b', 'fetch')) == 2
+    # The command line overrides the configuration.
+    runs.clear()
+    operations = gepare.Operations(refresh=True, state=state, max_age=0)
+    assert operations.run(packages)
+    assert [r.args[1] for r in runs].count('fetch') == 2
+
+def test_refresh_interval_invalid(monkeypatch, capsys):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    packages = make_packages(refresh_interval='1h')
+    packages[0].info = gepare.Expander({'refresh_interval': 'x'})
+    state = StateStore()
+    operations = gepare.Operations(refresh=True, state=state)
+    assert not operations.run(packages)
+    assert "a: refresh_interval: invalid duration ‘x’" in (
+        capsys.readouterr().err)
+    assert [r.args[1] for r in runs].count('fetch') == 1
+    assert state.history('a', 'fetch') == []
+    assert len(state.history('b', 'fetch')) == 1
+
+def test_max_age_remote(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    # Fresh packages neither update their mirror nor probe the remote.
+    packages = make_packages()
+    for package in packages:
+        package.origin.options = gepare.Expander({
+            'CACHE_HOME': '/cache',
+            'mirror': True
+        })
+    packages[1].origin.remote = 'other'
+    state = StateStore()
+    state.record('a', 'fetch', time.time() - 60, 1.0, 0, None, None, 0)
+    operations = gepare.Operations(
+        refresh=True, only_upgradable=True, state=state, max_age=3600)
+    assert operations.run(packages)
+    assert [r.args for r in runs if r.args[1] == 'ls-remote'] == [
+        ['git', 'ls-remote', '--heads', 'other']
+    ]
+    assert [r.args for r in runs].count(['git', 'fetch', '--prune',
+                                         'origin']) == 1
+
+def test_same_name(monkeypatch):
+    fake_run, runs = testutil.make_run()
+    monkeypatch.setattr(subprocess, 'run', fake_run)
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    monkeypatch.setattr(Path, 'is_dir', lambda _: True)
+
+    # Packages with one `name`, such as a plugin for two editors.
+    packages = [
+        gepare.Package('plugin', gepare.GitOrigin('plugin', 'remote',
+                                                  Path(key)),
+                       gepare.Expander({'key': key})) for key in ('vim', 'neo')
+    ]
+    state = StateStore()
+    state.record('vim', 'fetch', time.time() - 60, 1.0, 0, None, None, 0)
+    operations = gepare.Operations(refresh=True, state=state, max_age=3600)
+    assert operations.run(packages)
+    assert [r.args[1] for r in runs].count('fetch') == 1
+    assert len(state.history('neo', 'fetch')) == 1
+    assert state.history('plugin', 'fetch') == []
+
+def test_duration():
+    state = StateStore()
+    assert state.duration('a', 'fetch') is None
+    for i, duration in enumerate([9.0, 1.0, 2.0, 3.0, 4.0, 5.0]):
+        state.record('a', 'fetch', float(i), duration, 0, None, None, 0)
+    state.record('a', 'fetch', 10.0, 100.0, 1, None, None, 0)
+    # The median of the last five successful runs.
+    assert state.duration('a', 'fetch') == 3.0
+
+def test_costs(monkeypatch):
+    monkeypatch.setattr(Path, 'exists', lambda _: True)
+    sizes = {'a': 1000, 'b': 4000, 'c': None, 'd': 2000}
+    monkeypatch.setattr(gepare.GitOrigin, 'size',
+                        lambda self: sizes[self.name])
+    packages = [
+        gepare.Package(name, gepare.GitOrigin(name, 'remote', Path(name)),
+                       gepare.Expander({})) for name in 'abcd'
+    ]
+    state = StateStore()
+    operations = gepare.Operations(refresh=True, state=state)
+    costs, predictable = operations._costs(packages)
+    assert not predictable
+    assert list(costs.values()) == [1000, 4000, 0, 2000]
+
+    state.record('a', 'fetch', 0.0, 2.0, 0, None, None, 0)
+    state.record('c', 'fetch', 0.0, 4.0, 0, None, None, 0)
+    costs, predictable = operations._costs(packages)
+    assert predictable
+    # `b` and `d` are scaled by `a`'s rate.
+    assert list(costs.values()) == [2.0, 8.0, 4.0, 4.0]
@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: MIT
+"""Test Template."""
+
+from collections import ChainMap
+
+import pytest
+
+from gepare import Expander, Field, Template
+
+SCOPE = {'a': 'A', 'n': 3.14159, 'w': 6, 'l': [1, {'k': 'v'}]}
+
+@pytest.mark.parametrize('source', [
+    'plain',
+    'x{{y}}z',
+    '{a}',
+    '<{a}-{a}>',
+    '{n:.2f}',
+    '{a!r:>{w}}',
+    '{l[1][k]}',
+    '{l[0]:03}',
+    '{n.real}',
+])
+def test_template_render(source):
+    assert Template.compile(source).render(SCOPE) == source.format_map(SCOPE)
+
+def test_template_compiled_once():
+    assert Template.compile('{a}/{b}') is Template.compile('{a}/{b}')
+
+def test_template_parts():
+    t = Template.compile('x{a.b[0]!r:{w}}')
+    assert t.parts == [
+        'x', Field('a', ((True, 'b'), (False, 0)), 'r', Template.compile('{w}'))
+    ]
+    assert t.text is None
+    assert Template.compile('{{x}}').text == '{x}'
+
+@pytest.mark.parametrize('source', [
+    '{0}', '{}', '{0.a}', '{a!x}', '{a', '}', '{a.}', '{a..b}', '{a[]}',
+    '{a[0}', '{a[0]b}'
+])
+def test_template_invalid(source):
+    with pytest.raises(ValueError):
+        Template.compile(source)
+
+def test_template_missing():
+    with pytest.raises(KeyError):
+        Template.compile('{missing}').render(SCOPE)
+
+def test_template_render_each():
+    glo = {'g': '{h}/g', 'h': 'H', 'p': 'P', 'q': '{p}!'}
+    shared = Expander(ChainMap(glo))
+    scopes = [
+        Expander(ChainMap({'name': 'one'}, glo), shared),
+        Expander(ChainMap({'name': 'two', 'p': 'two'}, glo), shared),
+    ]
+    t = Template.compile('{g}:{name}:{q}')
+    assert t.render_each(scopes, shared) == ['H/g:one:P!', 'H/g:two:two!']
+    assert 'g' in shared.cache
+    assert 'g' not in scopes[0].cache
+    assert 'q' not in scopes[0].cache
+    assert 'q' in scopes[1].cache
+
+def test_template_render_each_missing():
+    shared = Expander({})
+    with pytest.raises(KeyError):
+        Template.compile('{x}').render_each([shared], shared)
+    assert Template.compile('x').render_each([shared] * 2, shared) == ['x'] * 2
@@ -4,6 +4,8 @@
 import io
 import pathlib
 
+import tomllib
+
 import testutil
 
 from gepare import read_toml, toml_escape
@@ -20,6 +22,38 @@ def test_read_toml_stream(monkeypatch):
     r = read_toml([io.BytesIO(toml)])
     assert r == {'key': 'value'}
 
+def test_read_toml_cached(monkeypatch, tmp_path):
+    file = tmp_path / 'a.toml'
+    file.write_bytes(b'key = "value"\n[t]\nx = 1\n')
+    cache = tmp_path / 'cache'
+    assert read_toml([file], cache) == {'key': 'value', 't': {'x': 1}}
+    assert len(list(cache.iterdir())) == 1
+
+    def fail(*_):
+        raise AssertionError
+
+    with monkeypatch.context() as m:
+        m.setattr(tomllib, 'load', fail)
+        assert read_toml([file], cache) == {'key': 'value', 't': {'x': 1}}
+
+    # Streams are layered on top, without changing what is cached.
+    define = io.BytesIO(b't.x = 2')
+    assert read_toml([file, define], cache) == {'key': 'value', 't': {'x': 2}}
+    with monkeypatch.context() as m:
+        m.setattr(tomllib, 'load', fail)
+        assert read_toml([file], cache) == {'key': 'value', 't': {'x': 1}}
+
+    file.write_bytes(b'key = "changed"\n')
+    assert read_toml([file], cache) == {'key': 'changed'}
+
+def test_read_toml_cache_unusable(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        pathlib.Path, 'open',
+        testutil.fake_mapped({'file': io.BytesIO(b'key = "value"')}))
+    cache = tmp_path / 'cache'
+    assert read_toml(['file'], cache) == {'key': 'value'}
+    assert not cache.exists()
+
 def test_toml_escape():
     assert (toml_escape('This is a "test" with \\ and \n, OK?') ==
             r'This is a \u0022test\u0022 with \u005C and \u000A, OK?')
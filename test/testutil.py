@@ -29,16 +29,46 @@ def make_none() -> tuple[Callable, list]:
 
     return fake, record
 
-def make_run() -> tuple[Callable, list[subprocess.CompletedProcess]]:
+def make_run(
+    results: Mapping[str, tuple[int, str]] | None = None,
+) -> tuple[Callable, list[subprocess.CompletedProcess]]:
+    """Fake `subprocess.run`, with results keyed by the first two args."""
     record: list[subprocess.CompletedProcess] = []
 
     def fake(args: list[str], **_) -> subprocess.CompletedProcess:
-        cp = subprocess.CompletedProcess(args, 0, '', '')
+        returncode, stdout = (results or {}).get(' '.join(args[: 2]), (0, ''))
+        cp = subprocess.CompletedProcess(args, returncode, stdout, '')
         record.append(cp)
         return cp
 
     return fake, record
 
+def make_arun(
+    results: Mapping[str, tuple[int, str]] | None = None,
+) -> tuple[Callable, list[list[str]]]:
+    """Fake `asyncio.create_subprocess_exec`, with results as `make_run`."""
+    record: list[list[str]] = []
+
+    class FakeProcess:
+
+        def __init__(self, returncode: int, stdout: str) -> None:
+            self.returncode = returncode
+            self.stdout = stdout
+
+        async def communicate(self) -> tuple[bytes, bytes]:
+            return self.stdout.encode(), b''
+
+    async def fake(*args: str, **_) -> FakeProcess:
+        record.append(list(args))
+        return FakeProcess(*(results or {}).get(' '.join(args[: 2]), (0, '')))
+
+    return fake, record
+
+def bytesio() -> io.BytesIO:
+    b = io.BytesIO()
+    b.close = lambda: None
+    return b
+
 def stringio() -> io.StringIO:
     s = io.StringIO()
     s.close = lambda: None